@@ -1,12 +1,40 @@
+import multiprocessing
+import os
+import time
+import warnings
+
 import numpy as np
 from random import randrange
 
-def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
+def eval_numerical_gradient(f, x, verbose=True, h=0.00001, num_workers=1,
+                            batch_size=None, method='central', complex_h=1e-20):
   """ 
   a naive implementation of numerical gradient of f at x 
   - f should be a function that takes a single argument
   - x is the point (numpy array) to evaluate the gradient at
+  - num_workers: if greater than 1, shard the coordinates of x across this
+    many worker processes; see eval_numerical_gradient_parallel
+  - batch_size: if not None, f is batched: it accepts an array of shape
+    (B,) + x.shape holding B perturbed copies of x and returns an array of
+    shape (B,) giving f for each copy; up to 2 * batch_size copies are
+    evaluated in each call.
+  - method: either 'central' for centered differences or 'complex' for the
+    complex step method, which falls back to centered differences if f turns
+    out not to support it; see eval_numerical_gradient_complex
+  - complex_h: step size for the complex step method
   """ 
+  if method == 'complex':
+    grad = eval_numerical_gradient_complex(f, x, None, h=complex_h,
+                                           probe_h=h)
+    if grad is not None:
+      return grad
+  elif method != 'central':
+    raise ValueError('Invalid method "%s"' % method)
+
+  if num_workers > 1 or batch_size is not None:
+    return eval_numerical_gradient_parallel(f, x, None, h=h,
+                                            num_workers=num_workers,
+                                            batch_size=batch_size)
 
   fx = f(x) # evaluate function value at original point
   grad = np.zeros_like(x)
@@ -32,11 +60,34 @@ def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
   return grad
 
 
-def eval_numerical_gradient_array(f, x, df, h=1e-5):
+def eval_numerical_gradient_array(f, x, df, h=1e-5, num_workers=1,
+                                  batch_size=None, method='central',
+                                  complex_h=1e-20):
   """
   Evaluate a numeric gradient for a function that accepts a numpy
   array and returns a numpy array.
+
+  If num_workers is greater than 1 the coordinates of x are sharded across
+  worker processes. If batch_size is not None, f must be batched: it accepts
+  an array of shape (B,) + x.shape and returns an array of shape
+  (B,) + df.shape. See eval_numerical_gradient_parallel for details.
+
+  If method is 'complex', use the complex step method with step complex_h,
+  falling back to centered differences for functions that do not support it;
+  see eval_numerical_gradient_complex.
   """
+  if method == 'complex':
+    grad = eval_numerical_gradient_complex(f, x, df, h=complex_h, probe_h=h)
+    if grad is not None:
+      return grad
+  elif method != 'central':
+    raise ValueError('Invalid method "%s"' % method)
+
+  if num_workers > 1 or batch_size is not None:
+    return eval_numerical_gradient_parallel(f, x, df, h=h,
+                                            num_workers=num_workers,
+                                            batch_size=batch_size)
+
   grad = np.zeros_like(x)
   it = np.nditer(x, flags=['multi_index'], op_flags=['readwrite'])
   while not it.finished:
@@ -54,6 +105,190 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
   return grad
 
 
+def _eval_numerical_gradient_coords(f, x, df, h, coords, batch_size=None):
+  """
+  Compute centered differences of f at x along the coordinates of x with the
+  flat indices given in coords, returning an array of shape (len(coords),).
+  If df is None then f returns a scalar, otherwise its output is contracted
+  with df. If batch_size is not None then f is batched as described in
+  eval_numerical_gradient_parallel.
+  """
+  grad = np.zeros(len(coords))
+  if batch_size is None:
+    for k, i in enumerate(coords):
+      ix = np.unravel_index(i, x.shape)
+      oldval = x[ix]
+      x[ix] = oldval + h
+      pos = np.copy(f(x))
+      x[ix] = oldval - h
+      neg = np.copy(f(x))
+      x[ix] = oldval
+      if df is not None:
+        grad[k] = np.sum((pos - neg) * df) / (2 * h)
+      else:
+        grad[k] = (pos - neg) / (2 * h)
+    return grad
+
+  x_row = x.reshape(1, -1)
+  for start in xrange(0, len(coords), batch_size):
+    idx = coords[start:start + batch_size]
+    B = len(idx)
+    # Stack B copies of x shifted by +h followed by B copies shifted by -h
+    xs = np.repeat(x_row, 2 * B, axis=0)
+    xs[np.arange(B), idx] += h
+    xs[B + np.arange(B), idx] -= h
+    out = f(xs.reshape((2 * B,) + x.shape))
+    diff = out[:B] - out[B:]
+    if df is not None:
+      diff = (diff * df).reshape(B, -1).sum(axis=1)
+    grad[start:start + B] = diff / (2 * h)
+  return grad
+
+
+# Arguments of eval_numerical_gradient_parallel, read by the worker processes.
+# Workers are forked, so they inherit these objects (and everything f refers
+# to) through copy-on-write shared memory instead of having them pickled.
+_parallel_args = {}
+
+
+def _eval_numerical_gradient_worker(coords):
+  a = _parallel_args
+  return _eval_numerical_gradient_coords(a['f'], a['x'], a['df'], a['h'],
+                                         coords, a['batch_size'])
+
+
+def eval_numerical_gradient_parallel(f, x, df=None, h=1e-5, num_workers=None,
+                                     batch_size=None):
+  """
+  Evaluate a numeric gradient using several processes and/or batched calls.
+
+  The coordinates of x are split into shards that are processed by a pool of
+  num_workers processes. The workers are forked after the arguments are set
+  up, so x, df and anything f closes over (such as a model and its data) are
+  shared with the parent through copy-on-write memory rather than copied. As
+  in the serial versions, each worker perturbs x in place, so f may either use
+  its argument or read x through a closure (for example a model parameter).
+  On platforms without fork, or if num_workers is 1, everything runs in the
+  current process.
+
+  If batch_size is not None, f must be batched: it receives an array of shape
+  (B,) + x.shape holding B perturbed copies of x and returns an array of shape
+  (B,) (if df is None) or (B,) + df.shape, giving the output for each copy.
+  Up to 2 * batch_size copies are evaluated in a single call, which amortizes
+  Python overhead for layers that accept an extra leading dimension.
+
+  Inputs:
+  - f: Function to differentiate.
+  - x: Numpy array giving the point at which to evaluate the gradient.
+  - df: Upstream gradient for functions returning arrays, or None if f returns
+    a scalar.
+  - h: Step size.
+  - num_workers: Number of worker processes; defaults to the number of CPUs.
+  - batch_size: Number of coordinates evaluated per call to a batched f, or
+    None if f is not batched.
+
+  Returns:
+  - grad: Numeric gradient, of the same shape as x.
+  """
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  coords = np.arange(x.size)
+
+  if num_workers <= 1 or not hasattr(os, 'fork'):
+    grad = _eval_numerical_gradient_coords(f, x, df, h, coords, batch_size)
+    return grad.reshape(x.shape).astype(x.dtype)
+
+  _parallel_args.update(f=f, x=x, df=df, h=h, batch_size=batch_size)
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    # Use a few shards per worker to balance the load
+    shards = np.array_split(coords, min(x.size, 4 * num_workers))
+    grads = pool.map(_eval_numerical_gradient_worker, shards)
+  finally:
+    pool.terminate()
+    _parallel_args.clear()
+  grad = np.concatenate(grads)
+  return grad.reshape(x.shape).astype(x.dtype)
+
+
+def _eval_complex_step_coords(f, x, df, h, coords):
+  """
+  Compute complex step derivatives of f at x along the coordinates of x with
+  the flat indices given in coords, returning an array of shape (len(coords),).
+  """
+  x_c = x.astype(np.complex128)
+  grad = np.zeros(len(coords))
+  for k, i in enumerate(coords):
+    ix = np.unravel_index(i, x.shape)
+    oldval = x_c[ix]
+    x_c[ix] = oldval + 1j * h
+    out = np.imag(f(x_c))
+    x_c[ix] = oldval
+    if df is not None:
+      grad[k] = np.sum(out * df) / h
+    else:
+      grad[k] = out / h
+  return grad
+
+
+def eval_numerical_gradient_complex(f, x, df=None, h=1e-20, probe_h=1e-5,
+                                    num_probes=3, tol=1e-5):
+  """
+  Evaluate a numeric gradient with the complex step method.
+
+  For a function that is analytic in x, f(x + ih e_k) = f(x) + ih df/dx_k +
+  O(h^2), so the derivative is Im(f(x + ih e_k)) / h. Unlike centered
+  differences this needs only one evaluation per coordinate and involves no
+  subtraction, so h can be tiny and the result is accurate to machine
+  precision. It works for affine layers, tanh and LSTM steps, batchnorm and
+  softmax, but f must use its argument (rather than reading x through a
+  closure), since x itself cannot hold complex values.
+
+  Functions that do not propagate imaginary parts correctly (for example ones
+  that write into real-valued buffers, like the naive convolution and max
+  pooling layers, or use abs) are detected by evaluating f at complex inputs
+  with ComplexWarning turned into an error, and by comparing the complex step
+  against centered differences at num_probes random coordinates. If any of
+  these checks fail we return None so that the caller can fall back to
+  centered differences.
+
+  Inputs:
+  - f: Function to differentiate.
+  - x: Numpy array giving the point at which to evaluate the gradient.
+  - df: Upstream gradient for functions returning arrays, or None if f returns
+    a scalar.
+  - h: Complex step size.
+  - probe_h: Step size of the centered differences used for probing.
+  - num_probes: Number of coordinates used to validate the complex step.
+  - tol: Relative tolerance used when comparing against centered differences.
+
+  Returns:
+  - grad: Numeric gradient, of the same shape as x, or None if f does not
+    support complex inputs.
+  """
+  rng = np.random.RandomState(0)
+  probe = rng.choice(x.size, min(num_probes, x.size), replace=False)
+  with warnings.catch_warnings():
+    warnings.simplefilter('error', np.ComplexWarning)
+    try:
+      if not np.iscomplexobj(f(x.astype(np.complex128))):
+        return None
+      probe_complex = _eval_complex_step_coords(f, x, df, h, probe)
+    except (TypeError, ValueError, np.ComplexWarning):
+      return None
+
+  probe_central = _eval_numerical_gradient_coords(f, x, df, probe_h, probe)
+  err = np.abs(probe_complex - probe_central)
+  if np.any(err > tol * (np.abs(probe_complex) + np.abs(probe_central)) + 1e-7):
+    return None
+
+  coords = np.arange(x.size)
+  with warnings.catch_warnings():
+    warnings.simplefilter('error', np.ComplexWarning)
+    grad = _eval_complex_step_coords(f, x, df, h, coords)
+  return grad.reshape(x.shape).astype(x.dtype)
+
+
 def eval_numerical_gradient_blobs(f, inputs, output, h=1e-5):
   """
   Compute numeric gradients for a function that operates on input
@@ -122,3 +357,135 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
     print 'numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error)
 
+
+
+def _sample_coord(rng, g_abs_cumsum, size, uniform_frac):
+  """
+  Sample a flat index into an array of the given size, uniformly with
+  probability uniform_frac and in proportion to gradient magnitude otherwise.
+  """
+  total = g_abs_cumsum[-1] if size > 0 else 0
+  if total <= 0 or rng.rand() < uniform_frac:
+    return rng.randint(size)
+  return min(np.searchsorted(g_abs_cumsum, rng.rand() * total, side='right'),
+             size - 1)
+
+
+def grad_check_model(model, X, y, max_evals=2000, time_limit=None, tol=1e-7,
+                     min_checks=3, confidence_z=2.33, uniform_frac=0.5,
+                     h=1e-5, seed=None, verbose=True):
+  """
+  Check the gradients of every parameter of a model against numeric gradients
+  of randomly sampled coordinates, under an evaluation or wall-clock budget.
+
+  The model must follow the Solver API: model.params is a dictionary of
+  parameter arrays and model.loss(X, y) returns (loss, grads). Use float64
+  parameters, and make the loss deterministic (e.g. pass a dropout seed),
+  otherwise the numeric gradients will be meaningless.
+
+  Every parameter is first checked at min_checks coordinates. Afterwards a
+  parameter is picked with probability proportional to an even mix of its
+  share of all parameter elements and its share of the total gradient
+  magnitude, and a coordinate within it is picked uniformly with probability
+  uniform_frac and in proportion to gradient magnitude otherwise. This spends
+  the budget on the coordinates that matter most without ignoring the rest.
+
+  Checking stops when the budget runs out, or early once the errors are
+  confidently under tolerance: every sampled error is below tol, and the
+  upper confidence bound of the mean log10 relative error (mean plus
+  confidence_z standard errors) is below log10(tol).
+
+  Inputs:
+  - model: Model object to check.
+  - X, y: Minibatch of data and labels to compute the loss on.
+  - max_evals: Maximum number of loss evaluations; each check costs two.
+  - time_limit: If not None, maximum number of seconds to spend.
+  - tol: Relative error tolerance.
+  - min_checks: Number of coordinates checked in each parameter up front.
+  - confidence_z: z-score used for the early-exit confidence bound.
+  - uniform_frac: Fraction of samples drawn uniformly within a parameter.
+  - h: Step size for centered differences.
+  - seed: Optional seed for the coordinate sampler.
+  - verbose: If True, print a summary for each parameter.
+
+  Returns:
+  A dictionary mapping each parameter name to a tuple (max_rel_error,
+  num_checks); max_rel_error is None for parameters that were not checked.
+  """
+  start_time = time.time()
+  rng = np.random.RandomState(seed)
+  loss, grads = model.loss(X, y)
+  names = sorted(model.params)
+
+  sizes = np.array([model.params[k].size for k in names], dtype=np.float64)
+  cumsums = [np.cumsum(np.abs(grads[k]).ravel()) for k in names]
+  mags = np.array([c[-1] if c.size > 0 else 0.0 for c in cumsums])
+  param_probs = 0.5 * sizes / sizes.sum()
+  if mags.sum() > 0:
+    param_probs += 0.5 * mags / mags.sum()
+  else:
+    param_probs *= 2
+
+  max_errors = {k: None for k in names}
+  num_checks = {k: 0 for k in names}
+  log_errors = []
+  num_evals = 0
+
+  def out_of_budget():
+    if num_evals + 2 > max_evals:
+      return True
+    return time_limit is not None and time.time() - start_time > time_limit
+
+  def confident():
+    if any(num_checks[k] < min_checks for k, n in zip(names, sizes) if n > 0):
+      return False
+    if max(e for e in max_errors.values() if e is not None) >= tol:
+      return False
+    logs = np.array(log_errors)
+    ucb = logs.mean() + confidence_z * logs.std() / np.sqrt(len(logs))
+    return ucb < np.log10(tol)
+
+  # First min_checks for every parameter, then proportional sampling
+  schedule = [i for _ in xrange(min_checks) for i in xrange(len(names))]
+  while not out_of_budget():
+    if schedule:
+      i = schedule.pop(0)
+    else:
+      if confident():
+        break
+      i = rng.choice(len(names), p=param_probs)
+    k = names[i]
+    if sizes[i] == 0:
+      continue
+    x = model.params[k]
+    ix = np.unravel_index(_sample_coord(rng, cumsums[i], x.size, uniform_frac),
+                          x.shape)
+
+    oldval = x[ix]
+    x[ix] = oldval + h
+    fxph = model.loss(X, y)[0]
+    x[ix] = oldval - h
+    fxmh = model.loss(X, y)[0]
+    x[ix] = oldval
+    num_evals += 2
+
+    grad_numerical = (fxph - fxmh) / (2 * h)
+    grad_analytic = grads[k][ix]
+    rel_error = abs(grad_numerical - grad_analytic) / max(
+        1e-8, abs(grad_numerical) + abs(grad_analytic))
+    if max_errors[k] is None or rel_error > max_errors[k]:
+      max_errors[k] = rel_error
+    num_checks[k] += 1
+    log_errors.append(np.log10(max(rel_error, 1e-16)))
+
+  results = {k: (max_errors[k], num_checks[k]) for k in names}
+  if verbose:
+    for k in names:
+      if max_errors[k] is None:
+        print '%s: not checked' % k
+      else:
+        print '%s max relative error: %e (%d checks)' % (k, max_errors[k],
+                                                         num_checks[k])
+    print '%d loss evaluations in %.2fs' % (num_evals,
+                                            time.time() - start_time)
+  return results
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+"""
+This file implements on-the-fly data augmentation for minibatches of images.
+Every function takes a minibatch X of shape (N, C, H, W) and returns a new
+randomly transformed minibatch of the same shape and dtype. All of them are
+vectorized over the minibatch with fancy indexing and broadcasting, so there
+are no per-image Python loops.
+
+All random numbers are drawn from the rng argument, a np.random.RandomState
+that defaults to the global np.random generator. The Solver passes its own
+generator, so that augmentation run on a prefetch thread does not share
+state with the main thread and training stays reproducible.
+
+Any of these functions (or augment_batch, which combines them) can be passed
+to the Solver as its batch_transform; use functools.partial to set their
+hyperparameters, for example:
+
+solver = Solver(model, data,
+                batch_transform=partial(augment_batch, crop_pad=4))
+"""
+
+
+def _crop_flip(X, pad, flip_prob, rng):
+  """
+  Shared implementation of random_crop and random_flip. Both only move pixels
+  around, so we build a single gather index that pads, crops and flips each
+  image and apply it to the whole minibatch at once.
+  """
+  N, C, H, W = X.shape
+  if pad > 0:
+    X = np.pad(X, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+
+  dy = rng.randint(0, 2 * pad + 1, size=N)
+  dx = rng.randint(0, 2 * pad + 1, size=N)
+  rows = dy[:, None] + np.arange(H)[None, :]
+  cols = dx[:, None] + np.arange(W)[None, :]
+  if flip_prob > 0:
+    flip = rng.rand(N) < flip_prob
+    cols[flip] = cols[flip, ::-1]
+
+  n_idx = np.arange(N)[:, None, None, None]
+  c_idx = np.arange(C)[None, :, None, None]
+  return X[n_idx, c_idx, rows[:, None, :, None], cols[:, None, None, :]]
+
+
+def random_crop(X, pad=4, rng=None):
+  """
+  Zero-pad each image by pad pixels on every side, then crop a random H x W
+  window out of the padded image.
+
+  Inputs:
+  - X: Minibatch of images, of shape (N, C, H, W)
+  - pad: Number of pixels of padding; each image is shifted by up to pad
+    pixels in each direction.
+  - rng: Random number generator; defaults to np.random.
+
+  Returns:
+  - out: Cropped images, of shape (N, C, H, W)
+  """
+  return _crop_flip(X, pad, 0.0, rng or np.random)
+
+
+def random_flip(X, p=0.5, rng=None):
+  """
+  Flip each image horizontally with probability p.
+
+  Inputs:
+  - X: Minibatch of images, of shape (N, C, H, W)
+  - p: Probability of flipping each image.
+  - rng: Random number generator; defaults to np.random.
+
+  Returns:
+  - out: Flipped images, of shape (N, C, H, W)
+  """
+  return _crop_flip(X, 0, p, rng or np.random)
+
+
+def color_jitter(X, brightness=0.1, contrast=0.1, rng=None):
+  """
+  Randomly perturb the brightness of each channel and the contrast of each
+  image.
+
+  Each image is scaled by a factor drawn uniformly from
+  [1 - contrast, 1 + contrast], then each of its channels is shifted by an
+  offset drawn uniformly from [-brightness, brightness] times the standard
+  deviation of the minibatch, so that the amount of jitter does not depend on
+  whether the data has been mean-subtracted or rescaled.
+
+  Inputs:
+  - X: Minibatch of images, of shape (N, C, H, W)
+  - brightness: Scalar giving the maximum relative brightness shift.
+  - contrast: Scalar giving the maximum relative contrast change.
+  - rng: Random number generator; defaults to np.random.
+
+  Returns:
+  - out: Jittered images, of shape (N, C, H, W)
+  """
+  rng = rng or np.random
+  N, C = X.shape[:2]
+  scale = 1 + rng.uniform(-contrast, contrast, size=(N, 1, 1, 1))
+  shift = rng.uniform(-brightness, brightness, size=(N, C, 1, 1))
+  shift *= X.std()
+  out = X * scale.astype(X.dtype) + shift.astype(X.dtype)
+  return out
+
+
+def augment_batch(X, crop_pad=4, flip_prob=0.5, brightness=0.1, contrast=0.1,
+                  rng=None):
+  """
+  Apply random cropping, horizontal flipping and color jitter to a minibatch.
+  Cropping and flipping share a single gather, so this costs about the same as
+  indexing the minibatch out of the training set plus one elementwise pass.
+
+  Inputs:
+  - X: Minibatch of images, of shape (N, C, H, W)
+  - crop_pad: Padding used for random cropping; 0 disables cropping.
+  - flip_prob: Probability of flipping each image; 0 disables flipping.
+  - brightness, contrast: Jitter strengths as in color_jitter; setting both
+    to 0 disables color jitter.
+  - rng: Random number generator; defaults to np.random.
+
+  Returns:
+  - out: Augmented images, of shape (N, C, H, W)
+  """
+  rng = rng or np.random
+  if crop_pad > 0 or flip_prob > 0:
+    X = _crop_flip(X, crop_pad, flip_prob, rng)
+  if brightness > 0 or contrast > 0:
+    X = color_jitter(X, brightness=brightness, contrast=contrast, rng=rng)
+  return X
@@ -18,7 +18,8 @@ class ThreeLayerConvNet(object):
   
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-               dtype=np.float32):
+               dtype=np.float32, compact_pool_cache=False, layout='NCHW',
+               checkpoint=None):
     """
     Initialize a new network.
     
@@ -32,10 +33,29 @@ class ThreeLayerConvNet(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - compact_pool_cache: If True, the max pooling layer only caches the
+      location of each maximum as a uint8 array, rather than its input and
+      output; this saves memory when training with large batches.
+    - layout: Memory layout used inside the convolutional layers, either
+      'NCHW' or 'NHWC' (channels-last). Inputs, parameters and gradients have
+      the same shapes either way; with 'NHWC' the input is converted once on
+      the way in and the pooled activations once on the way out.
+    - checkpoint: Recompute activations during the backward pass to save
+      memory. With 'conv' the convolutional layer only caches its input
+      rather than its im2col matrix; with 'layers' the conv - relu - pool
+      block only caches its input and is run forward again during the
+      backward pass. None (default) caches everything.
     """
+    if layout not in ('NCHW', 'NHWC'):
+      raise ValueError('Invalid layout "%s"' % layout)
+    if checkpoint not in (None, 'conv', 'layers'):
+      raise ValueError('Invalid checkpoint "%s"' % checkpoint)
     self.params = {}
     self.reg = reg
     self.dtype = dtype
+    self.compact_pool_cache = compact_pool_cache
+    self.layout = layout
+    self.checkpoint = checkpoint
     
     ############################################################################
     # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -94,10 +114,12 @@ class ThreeLayerConvNet(object):
     
     # pass conv_param to the forward pass for the convolutional layer
     filter_size = W1.shape[2]
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2,
+                  'checkpoint': self.checkpoint == 'conv'}
 
     # pass pool_param to the forward pass for the max-pooling layer
-    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                  'compact_cache': self.compact_pool_cache}
 
     scores = None
     ############################################################################
@@ -106,7 +128,17 @@ class ThreeLayerConvNet(object):
     # variable.                                                                #
     ############################################################################
     # Conv -> ReLU -> pool
-    out_crp, cache_crp = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+    if self.layout == 'NHWC':
+      crp_forward, X_crp = conv_relu_pool_forward_nhwc, to_nhwc(X)
+    else:
+      crp_forward, X_crp = conv_relu_pool_forward, X
+    if self.checkpoint == 'layers':
+      out_crp, cache_crp = checkpoint_forward(crp_forward, X_crp, W1, b1,
+                                              conv_param, pool_param)
+    else:
+      out_crp, cache_crp = crp_forward(X_crp, W1, b1, conv_param, pool_param)
+    if self.layout == 'NHWC':
+      out_crp = from_nhwc(out_crp)
 
     # affine -> ReLu
     N, F, H_crp, W_crp = out_crp.shape
@@ -143,7 +175,14 @@ class ThreeLayerConvNet(object):
 
     # conv + relu + pool <- affine + relu
     dx2 = dx2.reshape(N, F, H_crp, W_crp)
-    dx1, dW1, db1 = conv_relu_pool_backward(dx2, cache_crp)
+    if self.layout == 'NHWC':
+      crp_backward, dx2 = conv_relu_pool_backward_nhwc, to_nhwc(dx2)
+    else:
+      crp_backward = conv_relu_pool_backward
+    if self.checkpoint == 'layers':
+      dx1, dW1, db1 = checkpoint_backward(crp_backward, dx2, cache_crp)
+    else:
+      dx1, dW1, db1 = crp_backward(dx2, cache_crp)
     dW1 += self.reg * W1
     # dW1 = np.zeros(W1.shape)
     # db1 = np.zeros(b1.shape)
@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 
 from cs231n.layers import *
@@ -150,7 +152,8 @@ class FullyConnectedNet(object):
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0, use_batchnorm=False, reg=0.0,
-               weight_scale=1e-2, dtype=np.float32, seed=None):
+               weight_scale=1e-2, dtype=np.float32, seed=None,
+               sparse_threshold=None):
     """
     Initialize a new FullyConnectedNet.
     
@@ -170,6 +173,11 @@ class FullyConnectedNet(object):
     - seed: If not None, then pass this random seed to the dropout layers. This
       will make the dropout layers deteriminstic so we can gradient check the
       model.
+    - sparse_threshold: If not None, each hidden ReLU and the affine layer
+      that consumes its output take their sparse paths whenever the density
+      of the hidden activations (the fraction of nonzero entries) is below
+      sparse_threshold; see relu_forward and affine_forward. The measured
+      densities are returned by the sparsity_stats method.
     """
     self.use_batchnorm = use_batchnorm
     self.use_dropout = dropout > 0
@@ -227,6 +235,14 @@ class FullyConnectedNet(object):
       self.params.update(gammas)
       self.params.update(betas)
 
+    # With sparse_threshold we pass a sparse_param dictionary to each hidden
+    # ReLU and to the affine layer that consumes its output. Each layer only
+    # reads the threshold and adds its own measurements to the statistics.
+    self.sparse_params = []
+    if sparse_threshold is not None:
+      self.sparse_params = [{'threshold': sparse_threshold}
+                            for i in xrange(self.num_layers - 1)]
+
     # Cast all parameters to the correct datatype
     for k, v in self.params.iteritems():
       self.params[k] = v.astype(dtype)
@@ -247,7 +263,7 @@ class FullyConnectedNet(object):
       self.dropout_param['mode'] = mode   
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     ############################################################################
@@ -275,11 +291,18 @@ class FullyConnectedNet(object):
       w = self.params['W' + str(i)]
       b = self.params['b' + str(i)]
       intoLayer = layer[str(i-1)]
+      # sparse_params for the input of this layer and for its ReLU
+      sparse_in, sparse_out = None, None
+      if self.sparse_params:
+        if i > 1:
+          sparse_in = self.sparse_params[i - 2]
+        if i < self.L:
+          sparse_out = self.sparse_params[i - 1]
       # Dealing with dropout - different input to layer
 
       # deal with last layer
       if i == self.L:
-        out, cache_i = affine_forward(layer[str(i-1)], w, b)
+        out, cache_i = affine_forward(layer[str(i-1)], w, b, sparse_in)
         layer[str(i)] = out
         cache[str(i)] = cache_i
 
@@ -289,12 +312,13 @@ class FullyConnectedNet(object):
           beta = self.params['beta' + str(i)]
           bn_param = self.bn_params[i - 1]
 
-          out, cache_i = affine_norm_relu_forward(layer[str(i - 1)], w, b, gamma, beta, bn_param)
+          out, cache_i = affine_norm_relu_forward(layer[str(i - 1)], w, b, gamma, beta, bn_param,
+                                                  sparse_in, sparse_out)
           layer[str(i)] = out
           cache[str(i)] = cache_i
 
         else:
-          out, cache_i = affine_relu_forward(layer[str(i-1)], w, b)
+          out, cache_i = affine_relu_forward(layer[str(i-1)], w, b, sparse_in, sparse_out)
           layer[str(i)] = out
           cache[str(i)] = cache_i
 
@@ -384,9 +408,50 @@ class FullyConnectedNet(object):
 
     return loss, grads
 
+
+  def fold_batchnorm(self):
+    """
+    Return a copy of this network for inference, in which each batchnorm
+    layer is folded into the weights and biases of the affine layer before
+    it, using the running averages in self.bn_params (see
+    layer_utils.fold_batchnorm). The copy computes the same scores as this
+    network in test mode with {affine - relu} blocks only. It is a network
+    without batch normalization, so training it further does not train the
+    original architecture. This network is not modified.
+    """
+    model = copy.copy(self)
+    model.use_batchnorm = False
+    model.bn_params = []
+    model.dropout_param = dict(self.dropout_param)
+    model.sparse_params = [{'threshold': sparse_param['threshold']}
+                           for sparse_param in self.sparse_params]
+
+    model.params = {}
+    for k, v in self.params.iteritems():
+      if not k.startswith('gamma') and not k.startswith('beta'):
+        model.params[k] = v.copy()
+    if self.use_batchnorm:
+      for i in xrange(1, self.L):
+        w, b = fold_batchnorm(self.params['W' + str(i)], self.params['b' + str(i)],
+                              self.params['gamma' + str(i)],
+                              self.params['beta' + str(i)], self.bn_params[i - 1])
+        model.params['W' + str(i)], model.params['b' + str(i)] = w, b
+    return model
+
+
+  def sparsity_stats(self):
+    """
+    Return a list with the sparsity statistics of each hidden activation, as
+    measured by its ReLU and the affine layer that consumes it; see
+    layers.sparsity_stats. The list is empty if the network was constructed
+    without sparse_threshold.
+    """
+    return [sparsity_stats(sparse_param) for sparse_param in self.sparse_params]
+
 # Aux functions
 
-def affine_norm_relu_forward(x, w , b, gamma, beta, bn_param):
+def affine_norm_relu_forward(x, w , b, gamma, beta, bn_param, sparse_param=None,
+                            out_sparse_param=None):
   """
   Convenience layer that performs an affine transform followed by Batch normalization and ReLU
 
@@ -397,15 +462,16 @@ def affine_norm_relu_forward(x, w , b, gamma, beta, bn_param):
       gamma:
       beta:
       bn_param:
+      sparse_param, out_sparse_param: see affine_relu_forward
 
   Returns:
       out:
       cache:
   """
 
-  a, fc_cache = affine_forward(x, w, b)
-  out_norm, norm_cache = batchnorm_forward(a, gamma, beta, bn_param)
-  out_relu, relu_cache = relu_forward(out_norm)
+  a, fc_cache = affine_forward(x, w, b, sparse_param)
+  out_norm, norm_cache = batchnorm_forward_fused(a, gamma, beta, bn_param)
+  out_relu, relu_cache = relu_forward(out_norm, out_sparse_param)
   cache = (fc_cache, norm_cache, relu_cache)
   return out_relu, cache
 
@@ -421,6 +487,6 @@ def affine_norm_relu_backward(dout, cache):
   """
   fc_cache, norm_cache, relu_cache = cache
   drelu = relu_backward(dout, relu_cache)
-  dnorm, dgamma, dbeta = batchnorm_backward_alt(drelu, norm_cache)
+  dnorm, dgamma, dbeta = batchnorm_backward_fused(drelu, norm_cache)
   dx, dw, db = affine_backward(dnorm, fc_cache)
   return dx, dw, db, dgamma, dbeta
\ No newline at end of file
@@ -1,6 +1,9 @@
 import cPickle as pickle
+import collections
 import numpy as np
 import os
+import struct
+import zipfile
 from scipy.misc import imread
 
 def load_CIFAR_batch(filename):
@@ -176,24 +179,175 @@ def load_tiny_imagenet(path, dtype=np.float32):
   return class_names, X_train, y_train, X_val, y_val, X_test, y_test
 
 
-def load_models(models_dir):
+def _model_format(filename):
   """
-  Load saved models from disk. This will attempt to unpickle all files in a
-  directory; any files that give errors on unpickling (such as README.txt) will
-  be skipped.
+  Sniff the first bytes of a file to decide how it should be loaded. Returns
+  'npz' for zip archives written by np.savez, 'pickle' for files that start
+  with a pickle opcode, and None for anything else (such as README.txt).
+  """
+  with open(filename, 'rb') as f:
+    magic = f.read(4)
+  if magic == 'PK\x03\x04':
+    return 'npz'
+  if magic[:1] in ('\x80', '(', '}'):
+    return 'pickle'
+  return None
+
+
+def _mmap_npz(filename):
+  """
+  Open every array of an .npz archive without reading its data.
+
+  np.load ignores mmap_mode for .npz files and decompresses each member on
+  access. Archives written by np.savez are uncompressed, so each member is a
+  plain .npy file stored contiguously inside the zip; we find its offset and
+  memory-map it directly, which takes constant time regardless of the size of
+  the checkpoint. Compressed members and object arrays are read normally.
 
   Inputs:
-  - models_dir: String giving the path to a directory containing model files.
-    Each model file is a pickled dictionary with a 'model' field.
+  - filename: Path to an .npz file.
 
   Returns:
-  A dictionary mapping model file names to models.
+  A dictionary mapping array names to read-only arrays.
   """
-  models = {}
-  for model_file in os.listdir(models_dir):
-    with open(os.path.join(models_dir, model_file), 'rb') as f:
-      try:
-        models[model_file] = pickle.load(f)['model']
-      except pickle.UnpicklingError:
+  arrays = {}
+  with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+    for info in zf.infolist():
+      name = info.filename
+      if name.endswith('.npy'):
+        name = name[:-4]
+      if info.compress_type != zipfile.ZIP_STORED:
+        arrays[name] = np.lib.format.read_array(zf.open(info))
+        continue
+
+      # Skip the local file header to find the start of the .npy data
+      f.seek(info.header_offset)
+      header = f.read(30)
+      name_len, extra_len = struct.unpack('<HH', header[26:30])
+      f.seek(info.header_offset + 30 + name_len + extra_len)
+      version = np.lib.format.read_magic(f)
+      if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+      else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+      if dtype.hasobject or np.prod(shape) == 0:
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        arrays[name] = np.lib.format.read_array(f)
         continue
-  return models
+      order = 'F' if fortran_order else 'C'
+      arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                               order=order, offset=f.tell())
+  return arrays
+
+
+def save_model_npz(filename, model):
+  """
+  Save the weights of a model in the uncompressed NPZ format understood by
+  ModelRegistry, which can be opened much faster than a pickle.
+
+  Inputs:
+  - filename: Path of the file to write.
+  - model: Either a model object with a params dictionary, or a dictionary
+    mapping parameter names to numpy arrays.
+  """
+  params = getattr(model, 'params', model)
+  np.savez(filename, **params)
+
+
+class ModelRegistry(collections.Mapping):
+  """
+  A read-only dictionary of the saved models in a directory that only loads a
+  model the first time it is accessed.
+
+  Two file formats are supported:
+  - Pickle files holding a dictionary with a 'model' field; the value is the
+    unpickled model.
+  - NPZ files written by save_model_npz; the value is a dictionary mapping
+    parameter names to read-only memory-mapped arrays, so even very large
+    checkpoints open in constant time and are paged in as they are used.
+
+  Any other files in the directory (such as README.txt) are skipped. Loaded
+  models are kept in a least-recently-used cache holding at most cache_size
+  models; evicted models are simply loaded again on their next access.
+
+  Example usage:
+
+  models = ModelRegistry('cs231n/models', cache_size=2)
+  print models.keys()           # lists the files; nothing is loaded yet
+  model = models['best_model']  # loads just this model
+  """
+
+  def __init__(self, models_dir, cache_size=2):
+    """
+    Inputs:
+    - models_dir: String giving the path to a directory containing model files.
+    - cache_size: Maximum number of loaded models to keep in memory.
+    """
+    if cache_size < 1:
+      raise ValueError('cache_size must be positive, got %d' % cache_size)
+    self.models_dir = models_dir
+    self.cache_size = cache_size
+    self._cache = collections.OrderedDict()
+    self._formats = {}
+    for model_file in sorted(os.listdir(models_dir)):
+      path = os.path.join(models_dir, model_file)
+      if not os.path.isfile(path):
+        continue
+      fmt = _model_format(path)
+      if fmt is not None:
+        self._formats[model_file] = fmt
+
+  def __getitem__(self, model_file):
+    if model_file in self._cache:
+      # Move to the most-recently-used end
+      model = self._cache.pop(model_file)
+      self._cache[model_file] = model
+      return model
+
+    fmt = self._formats[model_file]
+    path = os.path.join(self.models_dir, model_file)
+    if fmt == 'npz':
+      model = _mmap_npz(path)
+    else:
+      with open(path, 'rb') as f:
+        model = pickle.load(f)['model']
+
+    self._cache[model_file] = model
+    while len(self._cache) > self.cache_size:
+      self._cache.popitem(last=False)
+    return model
+
+  def __iter__(self):
+    return iter(sorted(self._formats))
+
+  def __len__(self):
+    return len(self._formats)
+
+  def __contains__(self, model_file):
+    return model_file in self._formats
+
+  def clear_cache(self):
+    """ Drop all loaded models from memory. """
+    self._cache.clear()
+
+
+def load_models(models_dir, cache_size=2):
+  """
+  Load saved models from disk. Files that are neither pickles nor NPZ archives
+  (such as README.txt) will be skipped.
+
+  Models are loaded lazily: nothing is read from disk until a model is first
+  accessed, and at most cache_size loaded models are kept in memory. See
+  ModelRegistry for details.
+
+  Inputs:
+  - models_dir: String giving the path to a directory containing model files.
+    Each model file is either a pickled dictionary with a 'model' field or an
+    NPZ file written by save_model_npz.
+  - cache_size: Maximum number of loaded models to keep in memory.
+
+  Returns:
+  A dictionary-like ModelRegistry mapping model file names to models.
+  """
+  return ModelRegistry(models_dir, cache_size=cache_size)
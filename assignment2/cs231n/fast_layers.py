@@ -1,11 +1,22 @@
+import json
+import os
+import platform
+import time
+
 import numpy as np
+
+from cs231n import buffers
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
   from cs231n.im2col_cython import col2im_6d_cython
 except ImportError:
-  print 'run the following from the cs231n directory and try again:'
+  print 'The Cython extension is not built; using slower numpy fallbacks.'
+  print 'For full speed, run the following from the cs231n directory:'
   print 'python setup.py build_ext --inplace'
   print 'You may also need to restart your iPython kernel'
+  from cs231n.im2col import im2col_strided as im2col_cython
+  from cs231n.im2col import col2im_strided as col2im_cython
+  from cs231n.im2col import col2im_6d_strided as col2im_6d_cython
 
 from cs231n.im2col import *
 
@@ -18,68 +29,102 @@ def conv_forward_im2col(x, w, b, conv_param):
   N, C, H, W = x.shape
   num_filters, _, filter_height, filter_width = w.shape
   stride, pad = conv_param['stride'], conv_param['pad']
+  dilation = conv_param.get('dilation', 1)
+  span_h = dilation * (filter_height - 1) + 1
+  span_w = dilation * (filter_width - 1) + 1
 
   # Check dimensions
-  assert (W + 2 * pad - filter_width) % stride == 0, 'width does not work'
-  assert (H + 2 * pad - filter_height) % stride == 0, 'height does not work'
+  assert (W + 2 * pad - span_w) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - span_h) % stride == 0, 'height does not work'
 
   # Create output
-  out_height = (H + 2 * pad - filter_height) / stride + 1
-  out_width = (W + 2 * pad - filter_width) / stride + 1
+  out_height = (H + 2 * pad - span_h) / stride + 1
+  out_width = (W + 2 * pad - span_w) / stride + 1
   out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
   # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-  x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
+  x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride, dilation)
   res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
 
-  out1= res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
+  out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
   out = out.transpose(3, 0, 1, 2)
 
+  if conv_param.get('checkpoint', False):
+    # Keep only x; conv_backward_im2col rebuilds x_cols from it
+    x_cols = None
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def _strided_cols(x, HH, WW, stride, pad, dilation):
+  """
+  Return the im2col matrix used by conv_forward_strides, of shape
+  (C * HH * WW, N * out_h * out_w).
+  """
   N, C, H, W = x.shape
-  F, _, HH, WW = w.shape
-  stride, pad = conv_param['stride'], conv_param['pad']
-
-  # Check dimensions
-  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
-  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
   # Pad the input
   p = pad
-  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-  
+  x_padded = buffers.zeros((N, C, H + 2 * p, W + 2 * p), dtype=x.dtype)
+  x_padded[:, :, p:p + H, p:p + W] = x
+
   # Figure out output dimensions
   H += 2 * pad
   W += 2 * pad
-  out_h = (H - HH) / stride + 1
-  out_w = (W - WW) / stride + 1
+  out_h = (H - dilation * (HH - 1) - 1) / stride + 1
+  out_w = (W - dilation * (WW - 1) - 1) / stride + 1
 
-  # Perform an im2col operation by picking clever strides
+  # Perform an im2col operation by picking clever strides; a dilated filter
+  # just steps dilation pixels between its taps, so this is still a view
   shape = (C, HH, WW, N, out_h, out_w)
-  strides = (H * W, W, 1, C * H * W, stride * W, stride)
+  strides = (H * W, dilation * W, dilation, C * H * W, stride * W, stride)
   strides = x.itemsize * np.array(strides)
-
   x_stride = np.lib.stride_tricks.as_strided(x_padded,
                 shape=shape, strides=strides)
-  x_cols = np.ascontiguousarray(x_stride)
+  x_cols = buffers.empty(shape, dtype=x.dtype)
+  x_cols[...] = x_stride
   x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  buffers.release(x_padded)
+  return x_cols
+
+
+def conv_forward_strides(x, w, b, conv_param):
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  dilation = conv_param.get('dilation', 1)
+  span_h = dilation * (HH - 1) + 1
+  span_w = dilation * (WW - 1) + 1
+
+  # Check dimensions
+  assert (W + 2 * pad - span_w) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - span_h) % stride == 0, 'height does not work'
+
+  # Figure out output dimensions
+  out_h = (H + 2 * pad - span_h) / stride + 1
+  out_w = (W + 2 * pad - span_w) / stride + 1
+
+  x_cols = _strided_cols(x, HH, WW, stride, pad, dilation)
 
   # Now all our convolutions are a big matrix multiply
-  res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+  res = buffers.empty((F, N * out_h * out_w), dtype=np.result_type(w, x_cols))
+  np.dot(w.reshape(F, -1), x_cols, out=res)
+  res += b.reshape(-1, 1)
 
   # Reshape the output
   res.shape = (F, N, out_h, out_w)
-  out = res.transpose(1, 0, 2, 3)
 
   # Be nice and return a contiguous array
   # The old version of conv_forward_fast doesn't do this, so for a fair
   # comparison we won't either
-  out = np.ascontiguousarray(out)
+  out = buffers.empty((N, F, out_h, out_w), dtype=res.dtype)
+  out[...] = res.transpose(1, 0, 2, 3)
+  buffers.release(res)
 
+  if conv_param.get('checkpoint', False):
+    # Keep only x; conv_backward_strides rebuilds x_cols from it
+    buffers.release(x_cols)
+    x_cols = None
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
 
@@ -87,19 +132,32 @@ def conv_forward_strides(x, w, b, conv_param):
 def conv_backward_strides(dout, cache):
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
+  dilation = conv_param.get('dilation', 1)
 
   N, C, H, W = x.shape
   F, _, HH, WW = w.shape
   _, _, out_h, out_w = dout.shape
 
+  rebuilt = x_cols is None
+  if rebuilt:
+    x_cols = _strided_cols(x, HH, WW, stride, pad, dilation)
+
   db = np.sum(dout, axis=(0, 2, 3))
 
-  dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
+  dout_reshaped = buffers.empty((F, N, out_h, out_w), dtype=dout.dtype)
+  dout_reshaped[...] = dout.transpose(1, 0, 2, 3)
+  dout_reshaped.shape = (F, N * out_h * out_w)
   dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+  if rebuilt:
+    # Only the x_cols of the cache must stay; backward may run on it again
+    buffers.release(x_cols)
 
-  dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
+  dx_cols = buffers.empty((C * HH * WW, N * out_h * out_w),
+                          dtype=np.result_type(w, dout_reshaped))
+  np.dot(w.reshape(F, -1).T, dout_reshaped, out=dx_cols)
   dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride, dilation)
+  buffers.release(dout_reshaped, dx_cols)
 
   return dx, dw, db
 
@@ -111,33 +169,623 @@ def conv_backward_im2col(dout, cache):
   """
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
+  dilation = conv_param.get('dilation', 1)
 
   db = np.sum(dout, axis=(0, 2, 3))
 
   num_filters, _, filter_height, filter_width = w.shape
+  if x_cols is None:
+    x_cols = im2col_cython(x, filter_height, filter_width, pad, stride,
+                           dilation)
   dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
   dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
   dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
   # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
   dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                     filter_height, filter_width, pad, stride)
+                     filter_height, filter_width, pad, stride, dilation)
+
+  return dx, dw, db
+
+
+# Transform matrices for Winograd's minimal filtering algorithm F(2x2, 3x3),
+# from Lavin and Gray, "Fast Algorithms for Convolutional Neural Networks".
+# A 2x2 output tile is computed from a 4x4 input tile d and a 3x3 filter g as
+# A^T [(G g G^T) * (B^T d B)] A, using 16 multiplies instead of 36.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                         [0, 1, 1, 0],
+                         [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                         [0, 1, -1, -1]], dtype=np.float64)
+
+
+def winograd_applicable(w, conv_param):
+  """
+  Return True if conv_forward_winograd can be used for filters w with the
+  given conv_param; that is, for undilated 3x3 filters with stride 1.
+  """
+  return (w.shape[2] == w.shape[3] == 3 and conv_param['stride'] == 1 and
+          conv_param.get('dilation', 1) == 1)
+
+
+def _winograd_conv(x, w, pad):
+  """
+  Compute the stride-1 convolution (without bias) of x, of shape (N, C, H, W),
+  with 3x3 filters w, of shape (F, C, 3, 3), using Winograd F(2x2, 3x3).
+  """
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  out_h = H + 2 * pad - 2
+  out_w = W + 2 * pad - 2
+  tiles_h = (out_h + 1) / 2
+  tiles_w = (out_w + 1) / 2
+
+  # Pad the input so that it is covered by 4x4 tiles overlapping by 2 pixels
+  x_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  sN, sC, sH, sW = x_padded.strides
+  tiles = np.lib.stride_tricks.as_strided(x_padded,
+              shape=(N, C, tiles_h, tiles_w, 4, 4),
+              strides=(sN, sC, 2 * sH, 2 * sW, sH, sW))
+
+  BT = _WINOGRAD_BT.astype(x.dtype)
+  G = _WINOGRAD_G.astype(x.dtype)
+  AT = _WINOGRAD_AT.astype(x.dtype)
+
+  # Input transform B^T d B, giving V of shape (4, N, C, tiles_h, tiles_w, 4)
+  V = np.tensordot(BT, tiles, axes=([1], [4]))
+  V = np.tensordot(V, BT, axes=([5], [1]))
+  num_tiles = N * tiles_h * tiles_w
+  V = V.transpose(0, 5, 2, 1, 3, 4).reshape(16, C, num_tiles)
+
+  # Filter transform G g G^T, giving U of shape (4, F, C, 4)
+  U = np.tensordot(G, w.astype(x.dtype), axes=([1], [2]))
+  U = np.tensordot(U, G, axes=([3], [1]))
+  U = U.transpose(0, 3, 1, 2).reshape(16, F, C)
+
+  # Reduce over channels with one matrix multiply per tile element
+  M = np.matmul(U, V).reshape(4, 4, F, N, tiles_h, tiles_w)
+
+  # Output transform A^T M A, giving Y of shape (2, F, N, tiles_h, tiles_w, 2)
+  Y = np.tensordot(AT, M, axes=([1], [0]))
+  Y = np.tensordot(Y, AT, axes=([1], [1]))
+  out = Y.transpose(2, 1, 3, 0, 4, 5).reshape(N, F, 2 * tiles_h, 2 * tiles_w)
+  return out[:, :, :out_h, :out_w]
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer with
+  3x3 filters and stride 1, based on Winograd's F(2x2, 3x3) algorithm. This
+  uses 2.25 times fewer multiplies than a direct or im2col convolution.
+  """
+  assert winograd_applicable(w, conv_param), 'Winograd needs 3x3, stride 1'
+  out = _winograd_conv(x, w, conv_param['pad'])
+  out += b.reshape(1, -1, 1, 1)
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  Backward pass for conv_forward_winograd.
+
+  The gradient with respect to x is itself a 3x3, stride 1 convolution of dout
+  with the flipped filters, so it also uses Winograd. The gradient with respect
+  to w is computed as one matrix multiply per filter offset.
+  """
+  x, w, b, conv_param = cache
+  pad = conv_param['pad']
+  N, C, H, W = x.shape
+  _, _, out_h, out_w = dout.shape
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  w_flipped = w[:, :, ::-1, ::-1].transpose(1, 0, 2, 3)
+  if pad <= 2:
+    dx = _winograd_conv(dout, w_flipped, 2 - pad)
+  else:
+    dx = _winograd_conv(dout, w_flipped, 0)
+    dx = dx[:, :, pad - 2:pad - 2 + H, pad - 2:pad - 2 + W]
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    mode='constant')
+  dw = np.empty_like(w)
+  for i in xrange(3):
+    for j in xrange(3):
+      x_window = x_padded[:, :, i:i + out_h, j:j + out_w]
+      dw[:, :, i, j] = np.tensordot(dout, x_window, axes=([0, 2, 3], [0, 2, 3]))
 
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def _fft_inputs(x, w, pad):
+  """
+  Return the 2D real FFTs of the zero-padded input and of the filters, both
+  computed at the size of the padded input.
+  """
+  H, W = x.shape[2:]
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    mode='constant')
+  x_fft = np.fft.rfft2(x_padded, s=(Hp, Wp))
+  w_fft = np.fft.rfft2(w, s=(Hp, Wp))
+  return x_fft, w_fft
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer based
+  on the FFT. Its cost does not depend on the filter size, so it is the best
+  choice for large filters. Strided convolutions are computed at stride 1 and
+  then subsampled, so this is best used with stride 1.
+
+  If conv_param['checkpoint'] is True, then the transforms of x and w are not
+  kept in the cache, and the backward pass computes them again.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_h = (Hp - HH) / stride + 1
+  out_w = (Wp - WW) / stride + 1
+
+  # Circular cross-correlation in the frequency domain; with the padded input
+  # as the FFT size, the valid outputs do not wrap around.
+  x_fft, w_fft = _fft_inputs(x, w, pad)
+  K = x_fft.shape[2] * x_fft.shape[3]
+  x_t = x_fft.transpose(2, 3, 0, 1).reshape(K, N, C)
+  w_t = w_fft.conj().transpose(2, 3, 1, 0).reshape(K, C, F)
+  out_fft = np.matmul(x_t, w_t).reshape(x_fft.shape[2:] + (N, F))
+  out_full = np.fft.irfft2(out_fft.transpose(2, 3, 0, 1), s=(Hp, Wp))
+
+  out = out_full[:, :, :stride * out_h:stride, :stride * out_w:stride]
+  out = out.astype(x.dtype) + b.reshape(1, -1, 1, 1)
+
+  if conv_param.get('checkpoint', False):
+    x_fft, w_fft = None, None
+  cache = (x, w, b, conv_param, x_fft, w_fft)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  Backward pass for conv_forward_fft; both gradients are also computed in the
+  frequency domain, reusing the transforms of x and w from the forward pass
+  unless they were dropped by checkpointing.
+  """
+  x, w, b, conv_param, x_fft, w_fft = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  if x_fft is None:
+    x_fft, w_fft = _fft_inputs(x, w, pad)
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  # Spread dout back onto the stride-1 output grid
+  dout_full = np.zeros((N, F, Hp, Wp), dtype=dout.dtype)
+  dout_full[:, :, :stride * out_h:stride, :stride * out_w:stride] = dout
+  dout_fft = np.fft.rfft2(dout_full)
+  fft_shape = dout_fft.shape[2:]
+  K = fft_shape[0] * fft_shape[1]
+  dout_t = dout_fft.transpose(2, 3, 0, 1).reshape(K, N, F)
+
+  # dw is the cross-correlation of the padded input with dout
+  x_t = x_fft.transpose(2, 3, 0, 1).reshape(K, N, C)
+  dw_fft = np.matmul(dout_t.conj().transpose(0, 2, 1), x_t)
+  dw_fft = dw_fft.reshape(fft_shape + (F, C)).transpose(2, 3, 0, 1)
+  dw = np.fft.irfft2(dw_fft, s=(Hp, Wp))[:, :, :HH, :WW]
+
+  # dx is the full convolution of dout with the filters
+  w_t = w_fft.transpose(2, 3, 0, 1).reshape(K, F, C)
+  dx_fft = np.matmul(dout_t, w_t).reshape(fft_shape + (N, C))
+  dx_padded = np.fft.irfft2(dx_fft.transpose(2, 3, 0, 1), s=(Hp, Wp))
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx.astype(x.dtype), dw.astype(w.dtype), db
+
+
+def conv_forward_depthwise(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a depthwise convolutional
+  layer, where every input channel is convolved with its own set of filters
+  (conv_param['groups'] == C).
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w: Filter weights of shape (C * M, 1, HH, WW), where M is the number of
+    filters per input channel; filters c * M to c * M + M - 1 read channel c.
+  - b: Biases, of shape (C * M,)
+  - conv_param: As for conv_forward_naive.
+
+  Rather than looping over channels, this loops over the HH * WW filter
+  offsets, and multiplies a strided view of the padded input for each offset
+  by the per-channel weights at that offset, broadcast over the whole batch.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  assert w.shape[1] == 1 and F % C == 0, 'Invalid depthwise filter shape'
+  M = F / C
+  stride, pad = conv_param['stride'], conv_param['pad']
+  d = conv_param.get('dilation', 1)
+  out_h = (H + 2 * pad - d * (HH - 1) - 1) / stride + 1
+  out_w = (W + 2 * pad - d * (WW - 1) - 1) / stride + 1
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    mode='constant')
+  w_cm = w.reshape(C, M, HH, WW).astype(x.dtype)
+  out = np.zeros((N, C, M, out_h, out_w), dtype=x.dtype)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      y0, x0 = d * i, d * j
+      x_slice = x_padded[:, :, y0:y0 + stride * out_h:stride,
+                         x0:x0 + stride * out_w:stride]
+      out += x_slice[:, :, None] * w_cm[None, :, :, i, j, None, None]
+  out = out.reshape(N, F, out_h, out_w)
+  out += b.reshape(1, F, 1, 1)
+
+  cache = (x_padded, w, conv_param)
+  return out, cache
+
+
+def conv_backward_depthwise(dout, cache):
+  """
+  A fast implementation of the backward pass for a depthwise convolutional
+  layer, for the cache produced by conv_forward_depthwise.
+  """
+  x_padded, w, conv_param = cache
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  d = conv_param.get('dilation', 1)
+  N, C, H, W = x_padded.shape
+  H, W = H - 2 * pad, W - 2 * pad
+  M = F / C
+  _, _, out_h, out_w = dout.shape
+
+  db = dout.sum(axis=(0, 2, 3))
+  dout_cm = dout.reshape(N, C, M, out_h, out_w)
+  w_cm = w.reshape(C, M, HH, WW)
+  dw_cm = np.empty((C, M, HH, WW), dtype=w.dtype)
+  dx_padded = np.zeros(x_padded.shape, dtype=dout.dtype)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      y0, x0 = d * i, d * j
+      x_slice = x_padded[:, :, y0:y0 + stride * out_h:stride,
+                         x0:x0 + stride * out_w:stride]
+      dx_slice = dx_padded[:, :, y0:y0 + stride * out_h:stride,
+                           x0:x0 + stride * out_w:stride]
+      dw_cm[:, :, i, j] = np.einsum('ncmhw,nchw->cm', dout_cm, x_slice)
+      dx_slice += np.einsum('ncmhw,cm->nchw', dout_cm, w_cm[:, :, i, j])
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx, dw_cm.reshape(w.shape), db
+
+
+def conv_forward_grouped(x, w, b, conv_param):
+  """
+  Forward pass for a grouped convolutional layer with
+  G = conv_param['groups']: the input channels and the filters are split into
+  G groups, and each group of filters only sees its group of channels, so w
+  has shape (F, C / G, HH, WW). Each group is run as a dense convolution with
+  conv_forward_fast.
+  """
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  G = conv_param['groups']
+  assert C % G == 0 and F % G == 0, 'Channels must divide into groups'
+  assert w.shape[1] == C / G, 'Invalid grouped filter shape'
+  Cg, Fg = C / G, F / G
+
+  dense_param = dict(conv_param, groups=1)
+  outs, caches = [], []
+  for g in xrange(G):
+    out_g, cache_g = conv_forward_fast(x[:, g * Cg:(g + 1) * Cg],
+                                       w[g * Fg:(g + 1) * Fg],
+                                       b[g * Fg:(g + 1) * Fg], dense_param)
+    outs.append(out_g)
+    caches.append(cache_g)
+  out = np.concatenate(outs, axis=1)
+
+  cache = (Fg, caches)
+  return out, cache
+
+
+def conv_backward_grouped(dout, cache):
+  """
+  Backward pass for a grouped convolutional layer.
+  """
+  Fg, caches = cache
+  grads = [conv_backward_fast(dout[:, g * Fg:(g + 1) * Fg], cache_g)
+           for g, cache_g in enumerate(caches)]
+  dx = np.concatenate([dx_g for dx_g, _, _ in grads], axis=1)
+  dw = np.concatenate([dw_g for _, dw_g, _ in grads], axis=0)
+  db = np.concatenate([db_g for _, _, db_g in grads], axis=0)
+  return dx, dw, db
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer.
+
+  The implementation is selected with the optional conv_param['method']:
+  - 'strides' (default): conv_forward_strides, im2col through strided views.
+  - 'auto': the fastest method for this layer's shape, as measured by
+    conv_autotuner (see ConvAutotuner). This is opt-in: the first call for
+    each shape times every method, including the memory-hungry 'fft', and
+    since the selected method can differ between machines, so can the last
+    bits of the results.
+  - 'im2col': conv_forward_im2col, im2col through the Cython extension.
+  - 'winograd': conv_forward_winograd; layers that are not 3x3 with stride 1
+    fall back to 'strides'.
+  - 'fft': conv_forward_fft, best for large filters with stride 1.
+
+  Dilated layers (conv_param['dilation'] > 1) are supported by 'strides',
+  'im2col' and the grouped implementations; the other methods fall back to
+  'strides' for them.
+
+  If conv_param['checkpoint'] is True, then the 'strides' and 'im2col'
+  methods only keep x in the cache rather than its im2col matrix, which is
+  HH * WW times larger, and rebuild the matrix during the backward pass. This
+  trades an extra im2col per layer for a much smaller peak memory footprint
+  during training. Likewise, 'fft' drops the transforms of x and w and
+  'winograd' keeps nothing but its inputs anyway.
+
+  If conv_param['groups'] is greater than 1, then this is a grouped
+  convolution instead, and w has shape (F, C / groups, HH, WW). Depthwise
+  layers (groups == C) use conv_forward_depthwise, and other grouped layers
+  use conv_forward_grouped.
+  """
+  groups = conv_param.get('groups', 1)
+  if groups > 1:
+    method = 'depthwise' if groups == x.shape[1] else 'grouped'
+    conv_forward, _ = GROUPED_CONV_METHODS[method]
+    out, real_cache = conv_forward(x, w, b, conv_param)
+    cache = (method, real_cache)
+    return out, cache
+
+  method = conv_param.get('method', 'strides')
+  if method == 'auto':
+    method = conv_autotuner.select(x, w, b, conv_param)
+  if method == 'winograd' and not winograd_applicable(w, conv_param):
+    method = 'strides'
+  if method == 'fft' and conv_param.get('dilation', 1) > 1:
+    method = 'strides'
+  if method not in CONV_METHODS:
+    raise ValueError('Unrecognized method "%s"' % method)
+  conv_forward, _ = CONV_METHODS[method]
+  out, real_cache = conv_forward(x, w, b, conv_param)
+  cache = (method, real_cache)
+  return out, cache
+
+
+def conv_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer, using
+  the same method that was used by conv_forward_fast.
+  """
+  method, real_cache = cache
+  if method in GROUPED_CONV_METHODS:
+    _, conv_backward = GROUPED_CONV_METHODS[method]
+  elif method in CONV_METHODS:
+    _, conv_backward = CONV_METHODS[method]
+  else:
+    raise ValueError('Unrecognized method "%s"' % method)
+  return conv_backward(dout, real_cache)
+
+
+# Maps method names to (forward, backward) implementations for conv_forward_fast
+CONV_METHODS = {
+  'strides': (conv_forward_strides, conv_backward_strides),
+  'im2col': (conv_forward_im2col, conv_backward_im2col),
+  'winograd': (conv_forward_winograd, conv_backward_winograd),
+  'fft': (conv_forward_fft, conv_backward_fft),
+}
+
+# Implementations used by conv_forward_fast when conv_param['groups'] > 1
+GROUPED_CONV_METHODS = {
+  'depthwise': (conv_forward_depthwise, conv_backward_depthwise),
+  'grouped': (conv_forward_grouped, conv_backward_grouped),
+}
+
+
+def _cpu_model():
+  """
+  Return a string describing the CPU model, used to key the autotuning cache.
+  """
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith('model name'):
+          return line.split(':', 1)[1].strip()
+  except IOError:
+    pass
+  return platform.processor() or platform.machine() or 'unknown'
+
+
+class ConvAutotuner(object):
+  """
+  A ConvAutotuner picks the fastest convolution method for each layer shape.
+
+  The first time it sees a signature (x.shape, w.shape, stride, pad, dtype,
+  dilation and checkpoint), it times a forward and backward pass of each
+  applicable method in CONV_METHODS on the actual inputs. It then remembers
+  the fastest one in memory and, if it has a cache file, in a JSON file keyed
+  by the CPU model, so that later runs on the same machine can skip the
+  timing.
+
+  conv_forward_fast uses the module-level instance conv_autotuner when
+  conv_param['method'] is 'auto'. By default it keeps its selections in
+  memory only; set the environment variable CS231N_CONV_AUTOTUNE_CACHE to
+  the path of a JSON file (for example ~/.cs231n/conv_autotune.json) to keep
+  them across runs.
+  """
+
+  def __init__(self, cache_file=None, methods=None, num_trials=2):
+    """
+    Construct a new ConvAutotuner.
+
+    Inputs:
+    - cache_file: Path of the JSON file holding tuned selections, or None to
+      keep them in memory only.
+    - methods: List of method names in CONV_METHODS to choose between; if None
+      then all of them are considered.
+    - num_trials: Number of times each method is timed; the best time is used.
+    """
+    self.cache_file = cache_file
+    self.methods = methods
+    self.num_trials = num_trials
+    self.cpu_model = _cpu_model()
+    self.selections = {}
+    self.timings = {}
+    self._loaded = False
+
+
+  def _signature(self, x, w, conv_param):
+    """
+    Return the string under which the selection for a layer is stored.
+    """
+    signature = 'x=%s,w=%s,stride=%d,pad=%d,dtype=%s' % (
+        'x'.join(map(str, x.shape)), 'x'.join(map(str, w.shape)),
+        conv_param['stride'], conv_param['pad'], x.dtype.name)
+    dilation = conv_param.get('dilation', 1)
+    if dilation > 1:
+      signature += ',dilation=%d' % dilation
+    # Checkpointing changes what the backward pass computes, and so the timings
+    if conv_param.get('checkpoint', False):
+      signature += ',checkpoint'
+    return signature
+
+
+  def _read_cache_file(self):
+    """
+    Return the selections for all CPUs stored in the cache file.
+    """
+    if not self.cache_file or not os.path.isfile(self.cache_file):
+      return {}
+    try:
+      with open(self.cache_file) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+
+  def _load(self):
+    """
+    Merge the selections for this CPU from the cache file into memory.
+    """
+    entries = self._read_cache_file().get(self.cpu_model, {})
+    for signature, method in entries.iteritems():
+      if method in CONV_METHODS:
+        self.selections.setdefault(signature, method)
+    self._loaded = True
+
+
+  def _save(self):
+    """
+    Write the selections for this CPU to the cache file, keeping the entries
+    for other CPUs. Failing to write the file is not an error.
+    """
+    if not self.cache_file:
+      return
+    all_entries = self._read_cache_file()
+    entries = all_entries.setdefault(self.cpu_model, {})
+    entries.update(self.selections)
+    try:
+      cache_dir = os.path.dirname(self.cache_file)
+      if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+      with open(tmp_file, 'w') as f:
+        json.dump(all_entries, f, indent=2, sort_keys=True)
+      os.rename(tmp_file, self.cache_file)
+    except (IOError, OSError):
+      pass
+
+
+  def _benchmark(self, x, w, b, conv_param):
+    """
+    Time each candidate method on the given inputs; return a dictionary
+    mapping method names to their best forward + backward time in seconds.
+    Methods that cannot handle the inputs are left out.
+    """
+    methods = self.methods or sorted(CONV_METHODS)
+    timings = {}
+    for method in methods:
+      if method == 'winograd' and not winograd_applicable(w, conv_param):
+        continue
+      if method == 'fft' and conv_param.get('dilation', 1) > 1:
+        continue
+      conv_forward, conv_backward = CONV_METHODS[method]
+      best = None
+      try:
+        for _ in xrange(self.num_trials):
+          t0 = time.time()
+          out, cache = conv_forward(x, w, b, conv_param)
+          conv_backward(out, cache)
+          elapsed = time.time() - t0
+          best = elapsed if best is None else min(best, elapsed)
+      except AssertionError:
+        # Some methods only support some shapes
+        continue
+      timings[method] = best
+    return timings
+
+
+  def select(self, x, w, b, conv_param):
+    """
+    Return the name of the fastest method for the given layer, timing the
+    methods first if this signature has not been seen before.
+    """
+    if not self._loaded:
+      self._load()
+    signature = self._signature(x, w, conv_param)
+    method = self.selections.get(signature)
+    if method is None:
+      timings = self._benchmark(x, w, b, conv_param)
+      method = min(timings, key=timings.get) if timings else 'strides'
+      self.timings[signature] = timings
+      self.selections[signature] = method
+      self._save()
+    return method
+
+
+  def clear(self):
+    """
+    Forget all selections made in this process. The cache file is untouched,
+    but it is not read again.
+    """
+    self.selections = {}
+    self.timings = {}
+    self._loaded = True
+
+
+conv_autotuner = ConvAutotuner(cache_file=os.path.expanduser(
+    os.environ.get('CS231N_CONV_AUTOTUNE_CACHE', '')) or None)
 
 
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This chooses between the reshape method and the strides method. If the
+  pooling regions are square and tile the input image, then we can use the
+  reshape method which is very fast. Otherwise we fall back on the strides
+  method, which handles overlapping windows at a similar speed.
+
+  The reshape method caches the input and output of the layer. If
+  pool_param['compact_cache'] is True, then the strides method is used for all
+  pooling regions; it only caches the offset of the maximum within each
+  window as a uint8 array, which for 2x2 pooling of float32 data is 16 times
+  smaller than the output alone.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -145,12 +793,13 @@ def max_pool_forward_fast(x, pool_param):
 
   same_size = pool_height == pool_width == stride
   tiles = H % pool_height == 0 and W % pool_width == 0
-  if same_size and tiles:
+  compact = pool_param.get('compact_cache', False)
+  if same_size and tiles and not compact:
     out, reshape_cache = max_pool_forward_reshape(x, pool_param)
     cache = ('reshape', reshape_cache)
   else:
-    out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-    cache = ('im2col', im2col_cache)
+    out, strides_cache = max_pool_forward_strides(x, pool_param)
+    cache = ('strides', strides_cache)
   return out, cache
 
 
@@ -158,12 +807,14 @@ def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
+  This switches between the reshape, strides and im2col methods depending on
   which method was used to generate the cache.
   """
   method, real_cache = cache
   if method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
+  elif method == 'strides':
+    return max_pool_backward_strides(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
   else:
@@ -222,6 +873,204 @@ def max_pool_backward_reshape(dout, cache):
   return dx
 
 
+def _pool_window_slice(x, ii, jj, out_height, out_width, stride,
+                       channels_last=False):
+  """
+  Return the strided view of x of shape (N, C, out_height, out_width) holding
+  the element at offset (ii, jj) of every pooling window. If channels_last is
+  True, then x and the view have shapes (N, H, W, C) and
+  (N, out_height, out_width, C) instead.
+  """
+  if channels_last:
+    return x[:, ii:ii + stride * out_height:stride,
+             jj:jj + stride * out_width:stride]
+  return x[:, :, ii:ii + stride * out_height:stride,
+           jj:jj + stride * out_width:stride]
+
+
+def max_pool_forward_strides(x, pool_param, channels_last=False):
+  """
+  A fast implementation of the forward pass for a max pooling layer that works
+  for any pooling parameters, including overlapping windows.
+
+  Rather than gathering windows into columns as max_pool_forward_im2col does,
+  this loops over the pool_height * pool_width offsets within a window and
+  reduces a strided view of x for each one, so x is never copied. The cache
+  only holds the offset of the maximum within each window, stored in the
+  smallest unsigned integer type that fits (uint8 for windows of up to 256
+  elements).
+
+  If channels_last is True, then x has shape (N, H, W, C), and so does out.
+  """
+  if channels_last:
+    N, H, W, C = x.shape
+  else:
+    N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out_height = (H - pool_height) / stride + 1
+  out_width = (W - pool_width) / stride + 1
+
+  def window_slice(ii, jj):
+    return _pool_window_slice(x, ii, jj, out_height, out_width, stride,
+                              channels_last)
+
+  out = buffers.empty(window_slice(0, 0).shape, dtype=x.dtype)
+  out[...] = window_slice(0, 0)
+  for ii in xrange(pool_height):
+    for jj in xrange(pool_width):
+      np.maximum(out, window_slice(ii, jj), out=out)
+
+  # Walk the offsets backwards so that ties go to the first maximum, as with
+  # np.argmax
+  argmax_dtype = np.min_scalar_type(pool_height * pool_width - 1)
+  argmax = buffers.zeros(out.shape, dtype=argmax_dtype)
+  for k in reversed(xrange(pool_height * pool_width)):
+    ii, jj = divmod(k, pool_width)
+    np.putmask(argmax, window_slice(ii, jj) == out, k)
+
+  cache = (x.shape, argmax, pool_param, channels_last)
+  return out, cache
+
+
+def max_pool_backward_strides(dout, cache):
+  """
+  A fast implementation of the backward pass for a max pooling layer, for the
+  cache produced by max_pool_forward_strides. Each window offset routes dout
+  to the windows whose maximum it holds; overlapping windows accumulate.
+  """
+  x_shape, argmax, pool_param, channels_last = cache
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  if channels_last:
+    _, out_height, out_width, _ = dout.shape
+  else:
+    _, _, out_height, out_width = dout.shape
+
+  dx = buffers.zeros(x_shape, dtype=dout.dtype)
+  for k in xrange(pool_height * pool_width):
+    ii, jj = divmod(k, pool_width)
+    dx_slice = _pool_window_slice(dx, ii, jj, out_height, out_width, stride,
+                                  channels_last)
+    dx_slice += np.where(argmax == k, dout, 0)
+
+  return dx
+
+
+def avg_pool_forward_fast(x, pool_param):
+  """
+  A fast implementation of the forward pass for an average pooling layer.
+
+  As with max_pool_forward_fast, this uses the reshape method if the pooling
+  regions are square and tile the input image, and the strides method
+  otherwise.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  same_size = pool_height == pool_width == stride
+  tiles = H % pool_height == 0 and W % pool_width == 0
+  if same_size and tiles:
+    out, reshape_cache = avg_pool_forward_reshape(x, pool_param)
+    cache = ('reshape', reshape_cache)
+  else:
+    out, strides_cache = avg_pool_forward_strides(x, pool_param)
+    cache = ('strides', strides_cache)
+  return out, cache
+
+
+def avg_pool_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for an average pooling layer,
+  using the method that was used to generate the cache.
+  """
+  method, real_cache = cache
+  if method == 'reshape':
+    return avg_pool_backward_reshape(dout, real_cache)
+  elif method == 'strides':
+    return avg_pool_backward_strides(dout, real_cache)
+  else:
+    raise ValueError('Unrecognized method "%s"' % method)
+
+
+def avg_pool_forward_reshape(x, pool_param):
+  """
+  A fast implementation of the forward pass for the average pooling layer that
+  reshapes the input so that each pooling region gets its own pair of axes.
+
+  This can only be used for square pooling regions that tile the input.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  assert pool_height == pool_width == stride, 'Invalid pool params'
+  assert H % pool_height == 0
+  assert W % pool_width == 0
+  x_reshaped = x.reshape(N, C, H / pool_height, pool_height,
+                         W / pool_width, pool_width)
+  out = x_reshaped.mean(axis=(3, 5))
+
+  cache = (x.shape, pool_param)
+  return out, cache
+
+
+def avg_pool_backward_reshape(dout, cache):
+  """
+  A fast implementation of the backward pass for the average pooling layer
+  that uses the same reshaping as the forward pass.
+  """
+  x_shape, pool_param = cache
+  N, C, H, W = x_shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  dx_reshaped = np.empty((N, C, H / pool_height, pool_height,
+                          W / pool_width, pool_width), dtype=dout.dtype)
+  dx_reshaped[...] = dout[:, :, :, np.newaxis, :, np.newaxis]
+  dx_reshaped /= pool_height * pool_width
+  return dx_reshaped.reshape(x_shape)
+
+
+def avg_pool_forward_strides(x, pool_param):
+  """
+  A fast implementation of the forward pass for an average pooling layer that
+  works for any pooling parameters, summing one strided view of x for each
+  offset within a pooling window as in max_pool_forward_strides.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out_height = (H - pool_height) / stride + 1
+  out_width = (W - pool_width) / stride + 1
+
+  out = np.zeros((N, C, out_height, out_width), dtype=x.dtype)
+  for ii in xrange(pool_height):
+    for jj in xrange(pool_width):
+      out += _pool_window_slice(x, ii, jj, out_height, out_width, stride)
+  out /= pool_height * pool_width
+
+  cache = (x.shape, pool_param)
+  return out, cache
+
+
+def avg_pool_backward_strides(dout, cache):
+  """
+  A fast implementation of the backward pass for an average pooling layer, for
+  the cache produced by avg_pool_forward_strides.
+  """
+  x_shape, pool_param = cache
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  _, _, out_height, out_width = dout.shape
+
+  dout_scaled = dout / float(pool_height * pool_width)
+  dx = np.zeros(x_shape, dtype=dout.dtype)
+  for ii in xrange(pool_height):
+    for jj in xrange(pool_width):
+      dx_slice = _pool_window_slice(dx, ii, jj, out_height, out_width, stride)
+      dx_slice += dout_scaled
+  return dx
+
+
 def max_pool_forward_im2col(x, pool_param):
   """
   An implementation of the forward pass for max pooling based on im2col.
@@ -240,12 +1089,15 @@ def max_pool_forward_im2col(x, pool_param):
   out_width = (W - pool_width) / stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0,
+                          stride=stride, flat=True)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
 
-  cache = (x, x_cols, x_cols_argmax, pool_param)
+  # Only keep the compact argmax; x_cols is as large as the input or larger
+  argmax_dtype = np.min_scalar_type(pool_height * pool_width - 1)
+  cache = (x.shape, x_cols_argmax.astype(argmax_dtype), pool_param)
   return out, cache
 
 
@@ -256,16 +1108,147 @@ def max_pool_backward_im2col(dout, cache):
   This isn't much faster than the naive version, so it should be avoided if
   possible.
   """
-  x, x_cols, x_cols_argmax, pool_param = cache
-  N, C, H, W = x.shape
+  x_shape, x_cols_argmax, pool_param = cache
+  N, C, H, W = x_shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
   stride = pool_param['stride']
 
   dout_reshaped = dout.transpose(2, 3, 0, 1).flatten()
-  dx_cols = np.zeros_like(x_cols)
+  dx_cols = np.zeros((pool_height * pool_width, x_cols_argmax.size),
+                     dtype=dout.dtype)
   dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
   dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
-              padding=0, stride=stride)
-  dx = dx.reshape(x.shape)
+              padding=0, stride=stride, flat=True)
+  dx = dx.reshape(x_shape)
 
   return dx
+
+
+"""
+Channels-last (NHWC) layers. These take activations of shape (N, H, W, C)
+rather than (N, C, H, W), but use the same parameters as their NCHW
+counterparts: conv weights still have shape (F, C, HH, WW). With the
+channels innermost, the im2col patches of a convolution are a reshape of a
+strided view and its GEMM output already has the layout of the next
+activation, so no transposes are needed inside a network; models convert
+their input with to_nhwc once, and their output with from_nhwc.
+"""
+
+
+def to_nhwc(x):
+  """ Return a C-contiguous copy of x, of shape (N, C, H, W), as (N, H, W, C). """
+  return np.ascontiguousarray(x.transpose(0, 2, 3, 1))
+
+
+def from_nhwc(x):
+  """ Return a C-contiguous copy of x, of shape (N, H, W, C), as (N, C, H, W). """
+  return np.ascontiguousarray(x.transpose(0, 3, 1, 2))
+
+
+def _nhwc_cols(x, HH, WW, out_h, out_w, stride, pad, dilation):
+  """
+  Return the patch matrix used by conv_forward_nhwc, of shape
+  (N * out_h * out_w, HH * WW * C).
+  """
+  N, H, W, C = x.shape
+  x_padded = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)),
+                    mode='constant')
+  sN, sH, sW, sC = x_padded.strides
+  patches = np.lib.stride_tricks.as_strided(x_padded,
+                shape=(N, out_h, out_w, HH, WW, C),
+                strides=(sN, stride * sH, stride * sW,
+                         dilation * sH, dilation * sW, sC))
+  x_cols = np.ascontiguousarray(patches)
+  x_cols.shape = (N * out_h * out_w, HH * WW * C)
+  return x_cols
+
+
+def conv_forward_nhwc(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer on
+  channels-last data.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - w, b, conv_param: As for conv_forward_naive; w has shape (F, C, HH, WW).
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H', W', F)
+  - cache: Object to give to conv_backward_nhwc
+  """
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  d = conv_param.get('dilation', 1)
+  out_h = (H + 2 * pad - d * (HH - 1) - 1) / stride + 1
+  out_w = (W + 2 * pad - d * (WW - 1) - 1) / stride + 1
+
+  x_cols = _nhwc_cols(x, HH, WW, out_h, out_w, stride, pad, d)
+  w_cols = w.transpose(2, 3, 1, 0).reshape(HH * WW * C, F)
+
+  out = x_cols.dot(w_cols)
+  out += b
+  out.shape = (N, out_h, out_w, F)
+
+  if conv_param.get('checkpoint', False):
+    # Keep only x; conv_backward_nhwc rebuilds x_cols from it
+    x_cols = None
+  cache = (x, w, conv_param, x_cols)
+  return out, cache
+
+
+def conv_backward_nhwc(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer on
+  channels-last data.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H', W', F)
+  - cache: As from conv_forward_nhwc
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  - dw: Gradient with respect to w, of shape (F, C, HH, WW)
+  - db: Gradient with respect to b, of shape (F,)
+  """
+  x, w, conv_param, x_cols = cache
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  d = conv_param.get('dilation', 1)
+  _, out_h, out_w, _ = dout.shape
+
+  if x_cols is None:
+    x_cols = _nhwc_cols(x, HH, WW, out_h, out_w, stride, pad, d)
+
+  dout_cols = dout.reshape(N * out_h * out_w, F)
+  db = dout_cols.sum(axis=0)
+  dw = x_cols.T.dot(dout_cols).reshape(HH, WW, C, F)
+  dw = np.ascontiguousarray(dw.transpose(3, 2, 0, 1))
+
+  w_cols = w.transpose(2, 3, 1, 0).reshape(HH * WW * C, F)
+  dx_cols = dout_cols.dot(w_cols.T).reshape(N, out_h, out_w, HH, WW, C)
+  dx_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=dx_cols.dtype)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      y0, x0 = d * i, d * j
+      dx_padded[:, y0:y0 + stride * out_h:stride,
+                x0:x0 + stride * out_w:stride] += dx_cols[:, :, :, i, j]
+  dx = dx_padded[:, pad:pad + H, pad:pad + W]
+
+  return dx, dw, db
+
+
+def max_pool_forward_nhwc(x, pool_param):
+  """
+  A fast implementation of the forward pass for a max pooling layer on
+  channels-last data of shape (N, H, W, C); see max_pool_forward_strides.
+  """
+  return max_pool_forward_strides(x, pool_param, channels_last=True)
+
+
+def max_pool_backward_nhwc(dout, cache):
+  """
+  Backward pass for max_pool_forward_nhwc.
+  """
+  return max_pool_backward_strides(dout, cache)
@@ -1,8 +1,19 @@
 import numpy as np
 import time
 
+from cs231n import buffers
+try:
+  import scipy.sparse
+except ImportError:
+  scipy = None
 
-def affine_forward(x, w, b):
+
+# Default density below which relu_forward and affine_forward take their
+# sparse paths; see sparsity_stats to measure the density of a network.
+_SPARSE_DENSITY_THRESHOLD = 0.15
+
+
+def affine_forward(x, w, b, sparse_param=None):
   """
   Computes the forward pass for an affine (fully-connected) layer.
 
@@ -15,10 +26,18 @@ def affine_forward(x, w, b):
   - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
   - w: A numpy array of weights, of shape (D, M)
   - b: A numpy array of biases, of shape (M,)
+  - sparse_param: Optional dictionary for sparse inputs, such as the output of
+    a ReLU. If the density (fraction of nonzero entries) of x is below
+    sparse_param['threshold'] (default 0.15), x is converted to a CSR sparse
+    matrix, and the products with w and the weight gradient in
+    affine_backward only touch its nonzero entries, skipping the zeros of
+    every example. This needs scipy, and it only pays off for low densities
+    and wide layers; the density is recorded in sparse_param either way, see
+    sparsity_stats.
   
   Returns a tuple of:
   - out: output, of shape (N, M)
-  - cache: (x, w, b)
+  - cache: (x, w, b), or (x_csr, w, b, x.shape) on the sparse path
   """
   out = None
   #############################################################################
@@ -29,13 +48,21 @@ def affine_forward(x, w, b):
   xVecs = x.reshape((N, -1)) # NxD = N x (d_1*d_2*...*d_k)
   D = xVecs.shape[1]
 
-  z = np.dot(xVecs, w) + b # NxM
+  if sparse_param is not None and _use_sparse(xVecs, sparse_param, 'affine',
+                                              scipy is not None):
+    x_csr = scipy.sparse.csr_matrix(xVecs)
+    z = x_csr.dot(w) # only touches the nonzeros of x
+    cache = (x_csr, w, b, x.shape)
+  else:
+    z = buffers.empty((N, w.shape[1]), dtype=np.result_type(xVecs, w)) # NxM
+    np.dot(xVecs, w, out=z)
+    cache = (x, w, b)
+  z += b
 
   out = z
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
-  cache = (x, w, b)
   return out, cache
 
 
@@ -54,15 +81,25 @@ def affine_backward(dout, cache):
   - dw: Gradient with respect to w, of shape (D, M)
   - db: Gradient with respect to b, of shape (M,)
   """
-  x, w, b = cache
   #############################################################################
   # TODO: Implement the affine backward pass.                                 #
   #############################################################################
-  N, D = (x.reshape(x.shape[0], -1)).shape
-  xVecs = x.reshape((N, -1)) # NxD
-
-  dx = dout.dot(w.T).reshape(x.shape) # dx = dL/dz * dz/dx = dout * w
-  dw = xVecs.T.dot(dout) # dw = dL/dZ * dz/dw = dout * x
+  if len(cache) == 4:
+    # Sparse path: the product with the CSR matrix skips the zeros of x
+    x_csr, w, b, x_shape = cache
+    N, D = x_csr.shape
+    dx = buffers.empty(x_shape, dtype=np.result_type(dout, w))
+    np.dot(dout, w.T, out=dx.reshape(N, D)) # dx = dL/dz * dz/dx = dout * w
+    dw = x_csr.T.dot(dout) # dw = dL/dZ * dz/dw = dout * x
+  else:
+    x, w, b = cache
+    N, D = (x.reshape(x.shape[0], -1)).shape
+    xVecs = x.reshape((N, -1)) # NxD
+
+    dx = buffers.empty(x.shape, dtype=np.result_type(dout, w))
+    np.dot(dout, w.T, out=dx.reshape(N, D)) # dx = dL/dz * dz/dx = dout * w
+    dw = buffers.empty(w.shape, dtype=np.result_type(x, dout))
+    np.dot(xVecs.T, dout, out=dw) # dw = dL/dZ * dz/dw = dout * x
   db = np.sum(dout, axis=0) # db = dL/dz * dz/db = dout
 
   #############################################################################
@@ -71,16 +108,20 @@ def affine_backward(dout, cache):
   return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, sparse_param=None):
   """
   Computes the forward pass for a layer of rectified linear units (ReLUs).
 
   Input:
   - x: Inputs, of any shape
+  - sparse_param: Optional dictionary. If given, the density of the output is
+    recorded in it (see sparsity_stats), and if the density is below
+    sparse_param['threshold'] (default 0.15), the cache holds the indices of
+    the nonzero outputs instead of x.
 
   Returns a tuple of:
   - out: Output, of the same shape as x
-  - cache: x
+  - cache: x, or (x.shape, indices of the nonzero outputs) if sparse
   """
   #############################################################################
   # TODO: Implement the ReLU forward pass.                                    #
@@ -95,13 +136,17 @@ def relu_forward(x):
   # print time.time() - t
 
   # t = time.time()
-  out = np.maximum(0, x)
+  out = np.maximum(0, x, out=buffers.empty(x.shape, dtype=x.dtype))
   # print time.time() - t
 
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
-  cache = x
+  if sparse_param is not None and _use_sparse(out, sparse_param, 'relu'):
+    index_dtype = np.int32 if out.size < 2 ** 31 else np.int64
+    cache = (x.shape, np.flatnonzero(out).astype(index_dtype))
+  else:
+    cache = x
   return out, cache
 
 
@@ -111,7 +156,8 @@ def relu_backward(dout, cache):
 
   Input:
   - dout: Upstream derivatives, of any shape
-  - cache: Input x, of same shape as dout
+  - cache: Input x, of same shape as dout, or the compact cache of a sparse
+    relu_forward
 
   Returns:
   - dx: Gradient with respect to x
@@ -120,14 +166,72 @@ def relu_backward(dout, cache):
   #############################################################################
   # TODO: Implement the ReLU backward pass.                                   #
   #############################################################################
-  dx = dout
-  dx[x<0]=0
+  if isinstance(cache, tuple):
+    _, active = cache
+    dx = buffers.zeros(dout.shape, dtype=dout.dtype)
+    dx.reshape(-1)[active] = dout.reshape(-1)[active]
+  else:
+    dx = dout
+    dx[x<0]=0
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
   return dx
 
 
+def _sparse_stats(sparse_param):
+  return sparse_param.setdefault('stats', {
+    'relu_calls': 0, 'sparse_relu_calls': 0,
+    'affine_calls': 0, 'sparse_affine_calls': 0,
+    'density': None, 'density_sum': 0.0, 'density_count': 0,
+  })
+
+
+def _use_sparse(a, sparse_param, layer, available=True):
+  """
+  Measure the density (the fraction of nonzero entries) of the activations a,
+  record it in the statistics of sparse_param for the given layer ('relu' or
+  'affine'), and return whether the layer should take its sparse path, which
+  is when the density is below sparse_param['threshold'].
+  """
+  density = float(np.count_nonzero(a)) / max(a.size, 1)
+  use_sparse = available and density < sparse_param.get(
+      'threshold', _SPARSE_DENSITY_THRESHOLD)
+
+  stats = _sparse_stats(sparse_param)
+  stats['density'] = density
+  stats['density_sum'] += density
+  stats['density_count'] += 1
+  stats[layer + '_calls'] += 1
+  if use_sparse:
+    stats['sparse_' + layer + '_calls'] += 1
+  return use_sparse
+
+
+def sparsity_stats(sparse_param):
+  """
+  Return a dictionary of sparsity statistics for a sparse_param that has been
+  passed to relu_forward and / or affine_forward:
+  - relu_calls: Number of ReLU forward passes that measured their output.
+  - sparse_relu_calls: Number of those that kept a compact cache.
+  - affine_calls: Number of affine forward passes that measured their input.
+  - sparse_affine_calls: Number of those that took the sparse path.
+  - density: Fraction of nonzero entries in the last activations measured.
+  - mean_density: Average density over all measurements.
+  """
+  stats = _sparse_stats(sparse_param)
+  count = stats['density_count']
+  return {
+    'relu_calls': stats['relu_calls'],
+    'sparse_relu_calls': stats['sparse_relu_calls'],
+    'affine_calls': stats['affine_calls'],
+    'sparse_affine_calls': stats['sparse_affine_calls'],
+    'density': stats['density'],
+    'mean_density': stats['density_sum'] / count if count else None,
+  }
+
+
+
 def batchnorm_forward(x, gamma, beta, bn_param):
   """
   Forward pass for batch normalization.
@@ -171,8 +275,10 @@ def batchnorm_forward(x, gamma, beta, bn_param):
   momentum = bn_param.get('momentum', 0.9)
 
   N, D = x.shape
-  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
-  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+  # Running averages are always real, even when x is complex (as it is when
+  # gradient checking with the complex step method)
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.real.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.real.dtype))
 
   out, cache = None, None
   if mode == 'train':
@@ -190,13 +296,13 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     # storing your result in the running_mean and running_var variables.        #
     #############################################################################
     mean = np.mean(x, axis=0)
-    std = (np.std(x, axis=0)) ** 2
+    std = np.mean((x - mean) ** 2, axis=0)
 
     normx = (x - mean)/np.sqrt(std + eps)
     out = gamma * normx + beta
 
-    running_mean = momentum * running_mean + (1 - momentum) * mean
-    running_var = momentum * running_var + (1 - momentum) * std
+    running_mean = momentum * running_mean + (1 - momentum) * np.real(mean)
+    running_var = momentum * running_var + (1 - momentum) * np.real(std)
 
     # cache will contain terms needed for backprop
     # cache = (mean, std, gamma, beta, normx)
@@ -326,6 +432,100 @@ def batchnorm_backward_alt(dout, cache):
   return dx, dgamma, dbeta
 
 
+# Number of elements of x that batchnorm_forward_fused shifts at a time
+_BATCHNORM_BLOCK_SIZE = 1 << 16
+
+
+def batchnorm_forward_fused(x, gamma, beta, bn_param):
+  """
+  Fused forward pass for batch normalization; a drop-in replacement for
+  batchnorm_forward that uses less time and memory.
+
+  The mean and variance are computed together in a single pass over x, as
+  E[d] and E[d^2] - E[d]^2 for d = x - x[0]. Shifting by the first example
+  avoids the catastrophic cancellation of E[x^2] - E[x]^2 when the mean of a
+  feature is much larger than its standard deviation. The shifted rows are
+  formed a block at a time, so the extra memory does not grow with N, and the
+  sums are accumulated in float64 so that this stays accurate for float32
+  inputs. Normalization is done in place on a
+  single temporary, and the cache only holds x_hat and the inverse standard
+  deviation. The output and cache have the same dtype as x, so float32 data
+  is never upcast.
+
+  Inputs / outputs: Same as batchnorm_forward, except that the cache should be
+  passed to batchnorm_backward_fused.
+  """
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
+  N, D = x.shape
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.real.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.real.dtype))
+
+  if mode == 'train':
+    acc_dtype = np.promote_types(x.dtype, np.float64)
+    shift = x[0].astype(acc_dtype)
+    sum_d = np.zeros(D, dtype=acc_dtype)
+    sum_d2 = np.zeros(D, dtype=acc_dtype)
+    block = max(1, _BATCHNORM_BLOCK_SIZE // D)
+    for i in xrange(0, N, block):
+      d = x[i:i + block] - shift
+      sum_d += d.sum(axis=0)
+      sum_d2 += np.einsum('ij,ij->j', d, d)
+    mean_d = sum_d / N
+    mean = shift + mean_d
+    var = sum_d2 / N - mean_d * mean_d
+    if not np.iscomplexobj(var):
+      # Cancellation can make the variance of a constant feature negative
+      var = np.maximum(var, 0)
+
+    running_mean = momentum * running_mean + (1 - momentum) * np.real(mean)
+    running_var = momentum * running_var + (1 - momentum) * np.real(var)
+  elif mode == 'test':
+    mean, var = running_mean, running_var
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  inv_std = (1.0 / np.sqrt(var + eps)).astype(x.dtype)
+  x_hat = x - mean.astype(x.dtype)
+  x_hat *= inv_std
+  out = x_hat * gamma.astype(x.dtype)
+  out += beta.astype(x.dtype)
+
+  # Store the updated running means back into bn_param
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
+
+  cache = (x_hat, inv_std, gamma)
+  return out, cache
+
+
+def batchnorm_backward_fused(dout, cache):
+  """
+  Fused backward pass for batch normalization, for the cache produced by
+  batchnorm_forward_fused. This uses the closed form
+
+  dx = gamma * inv_std / N * (N * dout - dbeta - x_hat * dgamma)
+
+  computed in place on a single temporary.
+
+  Inputs / outputs: Same as batchnorm_backward.
+  """
+  x_hat, inv_std, gamma = cache
+  N, D = dout.shape
+
+  dbeta = dout.sum(axis=0)
+  dgamma = np.einsum('ij,ij->j', dout, x_hat)
+
+  dx = x_hat * dgamma
+  dx -= N * dout
+  dx += dbeta
+  dx *= (-gamma * inv_std / N).astype(dx.dtype)
+
+  return dx, dgamma, dbeta
+
+
 def dropout_forward(x, dropout_param):
   """
   Performs the forward pass for (inverted) dropout.
@@ -338,16 +538,23 @@ def dropout_forward(x, dropout_param):
       if the mode is test, then just return the input.
     - seed: Seed for the random number generator. Passing seed makes this
       function deterministic, which is needed for gradient checking but not in
-      real networks.
+      real networks. The mask is drawn from a private generator, so passing a
+      seed does not reseed numpy's global random state.
+    - mask_storage: How the mask is kept in the cache for the backward pass:
+      - 'full' (default): as a float64 array, 8 bytes per element.
+      - 'packed': as a bit-packed boolean array, 1 bit per element.
+      - 'seed': only the seed of the generator is kept, and the mask is
+        generated again in the backward pass.
 
   Outputs:
   - out: Array of the same shape as x.
   - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-    mask that was used to multiply the input; in test mode, mask is None.
+    mask that was used to multiply the input (or, with packed or seed storage,
+    a tuple from which dropout_backward rebuilds it); in test mode, mask is
+    None.
   """
   p, mode = dropout_param['p'], dropout_param['mode']
-  if 'seed' in dropout_param:
-    np.random.seed(dropout_param['seed'])
+  mask_storage = dropout_param.get('mask_storage', 'full')
 
   mask = None
   out = None
@@ -357,8 +564,22 @@ def dropout_forward(x, dropout_param):
     # TODO: Implement the training phase forward pass for inverted dropout.   #
     # Store the dropout mask in the mask variable.                            #
     ###########################################################################
-    mask = (np.random.rand(*x.shape) < p) / p
-    out = x * mask # drop!
+    # Each call gets its own generator; without a given seed, its seed is
+    # drawn from the global generator so np.random.seed still applies.
+    seed = dropout_param.get('seed')
+    if seed is None:
+      seed = np.random.randint(2 ** 31 - 1)
+    keep = _dropout_keep(seed, x.shape, p)
+    out = x * keep # drop!
+    out *= 1.0 / p
+    if mask_storage == 'full':
+      mask = keep / p
+    elif mask_storage == 'packed':
+      mask = ('packed', np.packbits(keep.ravel()), x.shape)
+    elif mask_storage == 'seed':
+      mask = ('seed', seed, x.shape)
+    else:
+      raise ValueError('Invalid mask_storage "%s"' % mask_storage)
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -377,6 +598,15 @@ def dropout_forward(x, dropout_param):
   return out, cache
 
 
+def _dropout_keep(seed, shape, p):
+  """
+  Return the boolean dropout mask of the given shape for a seed, keeping each
+  element with probability p.
+  """
+  rng = np.random.RandomState(seed)
+  return rng.rand(*shape) < p
+
+
 def dropout_backward(dout, cache):
   """
   Perform the backward pass for (inverted) dropout.
@@ -394,6 +624,15 @@ def dropout_backward(dout, cache):
     # TODO: Implement the training phase backward pass for inverted dropout.  #
     ###########################################################################
     # zero out the gradients w.r.t the places where mask==0 -> were dropped
+    if isinstance(mask, tuple):
+      storage, data, shape = mask
+      if storage == 'packed':
+        keep = np.unpackbits(data)[:np.prod(shape)].reshape(shape).view(bool)
+      else:
+        keep = _dropout_keep(data, shape, dropout_param['p'])
+      dx = dout * keep
+      dx *= 1.0 / dropout_param['p']
+    else:
       dx = dout * mask
     ###########################################################################
     #                            END OF YOUR CODE                             #
@@ -413,17 +652,23 @@ def conv_forward_naive(x, w, b, conv_param):
 
   Input:
   - x: Input data of shape (N, C, H, W)
-  - w: Filter weights of shape (F, C, HH, WW)
+  - w: Filter weights of shape (F, C / groups, HH, WW)
   - b: Biases, of shape (F,)
   - conv_param: A dictionary with the following keys:
     - 'stride': The number of pixels between adjacent receptive fields in the
       horizontal and vertical directions.
     - 'pad': The number of pixels that will be used to zero-pad the input.
+    - 'groups': Optional number of groups, default 1. The channels and filters
+      are split into this many groups, and each filter only sees the channels
+      of its own group; groups == C gives a depthwise convolution.
+    - 'dilation': Optional spacing between filter taps, default 1. A dilated
+      filter spans HH' = dilation * (HH - 1) + 1 rows and
+      WW' = dilation * (WW - 1) + 1 columns of the input.
 
   Returns a tuple of:
   - out: Output data, of shape (N, F, H', W') where H' and W' are given by
-    H' = 1 + (H + 2 * pad - HH) / stride
-    W' = 1 + (W + 2 * pad - WW) / stride
+    H' = 1 + (H + 2 * pad - HH') / stride
+    W' = 1 + (W + 2 * pad - WW') / stride
   - cache: (x, w, b, conv_param)
   """
   out = None
@@ -432,19 +677,23 @@ def conv_forward_naive(x, w, b, conv_param):
   # Hint: you can use the function np.pad for padding.                        #
   #############################################################################
   N, C, H, W = x.shape
-  F, _, HH, WW = w.shape
+  F, Cg, HH, WW = w.shape
   P, S = conv_param['pad'], conv_param['stride']
-  Hout = 1 + (H + 2 * P - HH) / S
-  Wout = 1 + (W + 2 * P - WW) / S
+  G = conv_param.get('groups', 1)
+  D = conv_param.get('dilation', 1)
+  HHd, WWd = D * (HH - 1) + 1, D * (WW - 1) + 1 # dilated filter size
+  Hout = 1 + (H + 2 * P - HHd) / S
+  Wout = 1 + (W + 2 * P - WWd) / S
 
   out = np.zeros((N, F, Hout, Wout))
   x_padded = np.pad(x, ((0,), (0,), (P,), (P,)), 'constant')
 
   for n in xrange(N): # all images
     for f in xrange(F): # all filters
+      c0 = f / (F / G) * Cg # first channel of this filter's group
       for hh in xrange(Hout):
         for ww in xrange(Wout):
-          out[n, f, hh, ww] = np.sum(x_padded[n, :, hh*S:hh*S+HH, ww*S:ww*S+WW] * w[f, :, :, :]) + b[f]
+          out[n, f, hh, ww] = np.sum(x_padded[n, c0:c0+Cg, hh*S:hh*S+HHd:D, ww*S:ww*S+WWd:D] * w[f, :, :, :]) + b[f]
 
 
   #############################################################################
@@ -472,10 +721,13 @@ def conv_backward_naive(dout, cache):
   #############################################################################
   x, w, b, conv_param = cache
   N, C, H, W = x.shape
-  F, _, HH, WW = w.shape
+  F, Cg, HH, WW = w.shape
   P, S = conv_param['pad'], conv_param['stride']
-  Hout = 1 + (H + 2 * P - HH) / S
-  Wout = 1 + (W + 2 * P - WW) / S
+  G = conv_param.get('groups', 1)
+  D = conv_param.get('dilation', 1)
+  HHd, WWd = D * (HH - 1) + 1, D * (WW - 1) + 1 # dilated filter size
+  Hout = 1 + (H + 2 * P - HHd) / S
+  Wout = 1 + (W + 2 * P - WWd) / S
 
   dx, dw, db = np.zeros_like(x), np.zeros_like(w), np.zeros_like(b)
   x_padded = np.pad(x, ((0,), (0,), (P,), (P,)), 'constant')
@@ -483,14 +735,15 @@ def conv_backward_naive(dout, cache):
 
   for n in xrange(N):  # all images
     for f in xrange(F):  # all filters
+      c0 = f / (F / G) * Cg # first channel of this filter's group
       for hh in xrange(Hout):
         for ww in xrange(Wout):
-          xWindow = x_padded[n, :, hh*S:hh*S+HH, ww*S:ww*S+WW]
+          xWindow = x_padded[n, c0:c0+Cg, hh*S:hh*S+HHd:D, ww*S:ww*S+WWd:D]
           doutWindow = dout[n, f, hh, ww]
 
           db[f] += doutWindow # db = sum(dout)
           dw[f] += xWindow * doutWindow
-          dx_padded[n, :, hh*S:hh*S+HH, ww*S:ww*S+WW] += w[f] * doutWindow
+          dx_padded[n, c0:c0+Cg, hh*S:hh*S+HHd:D, ww*S:ww*S+WWd:D] += w[f] * doutWindow
 
   dx = dx_padded[:, :, P:P+H, P:P+W]
 
@@ -581,6 +834,140 @@ def max_pool_backward_naive(dout, cache):
   return dx
 
 
+def avg_pool_forward_naive(x, pool_param):
+  """
+  A naive implementation of the forward pass for an average pooling layer.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+  - pool_param: dictionary with the following keys:
+    - 'pool_height': The height of each pooling region
+    - 'pool_width': The width of each pooling region
+    - 'stride': The distance between adjacent pooling regions
+
+  Returns a tuple of:
+  - out: Output data
+  - cache: (x, pool_param)
+  """
+  N, C, H, W = x.shape
+  h_pool = pool_param['pool_height']
+  w_pool = pool_param['pool_width']
+  S = pool_param['stride']
+  h_out = (H - h_pool) / S + 1
+  w_out = (W - w_pool) / S + 1
+  out = np.zeros((N, C, h_out, w_out))
+
+  for n in xrange(N):
+    for c in xrange(C):
+      for hh in xrange(h_out):
+        for ww in xrange(w_out):
+          out[n, c, hh, ww] = np.mean(x[n, c, hh*S:hh*S + h_pool, ww*S:ww*S + w_pool])
+
+  cache = (x, pool_param)
+  return out, cache
+
+
+def avg_pool_backward_naive(dout, cache):
+  """
+  A naive implementation of the backward pass for an average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives
+  - cache: A tuple of (x, pool_param) as in the forward pass.
+
+  Returns:
+  - dx: Gradient with respect to x
+  """
+  x, pool_param = cache
+  N, C, H, W = x.shape
+  h_pool = pool_param['pool_height']
+  w_pool = pool_param['pool_width']
+  S = pool_param['stride']
+  h_out = (H - h_pool) / S + 1
+  w_out = (W - w_pool) / S + 1
+
+  dx = np.zeros(x.shape)
+  for n in xrange(N):
+    for c in xrange(C):
+      for hh in xrange(h_out):
+        for ww in xrange(w_out):
+          dx[n, c, hh * S:hh * S + h_pool, ww * S:ww * S + w_pool] += dout[n, c, hh, ww] / float(h_pool * w_pool)
+  return dx
+
+
+def global_avg_pool_forward(x):
+  """
+  Forward pass for a global average pooling layer, which averages each
+  channel over all spatial positions.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C)
+  - cache: Shape of x, for the backward pass
+  """
+  out = x.mean(axis=(2, 3))
+  cache = x.shape
+  return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+  """
+  Backward pass for a global average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C)
+  - cache: Shape of x, as from global_avg_pool_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  N, C, H, W = cache
+  dx = np.empty(cache, dtype=dout.dtype)
+  dx[...] = (dout / float(H * W))[:, :, None, None]
+  return dx
+
+
+def global_max_pool_forward(x):
+  """
+  Forward pass for a global max pooling layer, which takes the maximum of each
+  channel over all spatial positions.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C)
+  - cache: (x_shape, argmax), where argmax gives the flat spatial position of
+    each maximum in the smallest unsigned integer type that fits.
+  """
+  N, C, H, W = x.shape
+  x_flat = x.reshape(N, C, H * W)
+  argmax = np.argmax(x_flat, axis=2)
+  out = x_flat.max(axis=2)
+  cache = (x.shape, argmax.astype(np.min_scalar_type(H * W - 1)))
+  return out, cache
+
+
+def global_max_pool_backward(dout, cache):
+  """
+  Backward pass for a global max pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C)
+  - cache: (x_shape, argmax) as from global_max_pool_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  x_shape, argmax = cache
+  N, C, H, W = x_shape
+  dx = np.zeros((N * C, H * W), dtype=dout.dtype)
+  dx[np.arange(N * C), argmax.ravel()] = dout.ravel()
+  return dx.reshape(x_shape)
+
+
 def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   """
   Computes the forward pass for spatial batch normalization.
@@ -612,7 +999,40 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
+  # Per-channel statistics are computed by reducing over axes (0, 2, 3) of x
+  # directly, and per-channel vectors are broadcast against shape (C, 1, 1),
+  # so x is never transposed into an (N * H * W, C) copy.
+  N, C, H, W = x.shape
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.real.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.real.dtype))
+
+  if mode == 'train':
+    mean = x.mean(axis=(0, 2, 3))
+    x_hat = x - mean.reshape(C, 1, 1)
+    var = np.einsum('nchw,nchw->c', x_hat, x_hat) / (N * H * W)
+
+    running_mean = momentum * running_mean + (1 - momentum) * np.real(mean)
+    running_var = momentum * running_var + (1 - momentum) * np.real(var)
+  elif mode == 'test':
+    var = running_var
+    x_hat = x - running_mean.astype(x.dtype).reshape(C, 1, 1)
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  inv_std = (1.0 / np.sqrt(var + eps)).astype(x.dtype)
+  x_hat *= inv_std.reshape(C, 1, 1)
+  out = x_hat * gamma.astype(x.dtype).reshape(C, 1, 1)
+  out += beta.astype(x.dtype).reshape(C, 1, 1)
+
+  # Store the updated running means back into bn_param
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
+
+  cache = (mode, x_hat, inv_std, gamma)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -642,7 +1062,24 @@ def spatial_batchnorm_backward(dout, cache):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  mode, x_hat, inv_std, gamma = cache
+  N, C, H, W = dout.shape
+  scale = (gamma * inv_std).astype(dout.dtype).reshape(C, 1, 1)
+
+  dbeta = dout.sum(axis=(0, 2, 3))
+  dgamma = np.einsum('nchw,nchw->c', dout, x_hat)
+  if mode == 'train':
+    # dx = gamma * inv_std * (dout - mean(dout) - x_hat * mean(dout * x_hat)),
+    # with the means taken over axes (0, 2, 3)
+    M = float(N * H * W)
+    dx = x_hat * (dgamma / M).astype(dout.dtype).reshape(C, 1, 1)
+    dx -= dout
+    dx += (dbeta / M).astype(dout.dtype).reshape(C, 1, 1)
+    dx *= -scale
+  elif mode == 'test':
+    dx = dout * scale
+  else:
+    raise ValueError('Invalid backward batchnorm mode "%s"' % mode)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -650,6 +1087,44 @@ def spatial_batchnorm_backward(dout, cache):
   return dx, dgamma, dbeta
   
 
+def spatial_batchnorm_forward_nhwc(x, gamma, beta, bn_param):
+  """
+  Computes the forward pass for spatial batch normalization on channels-last
+  data. Each channel is a column of x.reshape(-1, C), which is a view of x, so
+  this is plain batch normalization without any copies.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - gamma, beta, bn_param: As for spatial_batchnorm_forward
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H, W, C)
+  - cache: Values needed for the backward pass
+  """
+  C = x.shape[-1]
+  out, cache = batchnorm_forward_fused(x.reshape(-1, C), gamma, beta, bn_param)
+  return out.reshape(x.shape), cache
+
+
+def spatial_batchnorm_backward_nhwc(dout, cache):
+  """
+  Computes the backward pass for spatial batch normalization on channels-last
+  data.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H, W, C)
+  - cache: Values from the forward pass
+
+  Returns a tuple of:
+  - dx: Gradient with respect to inputs, of shape (N, H, W, C)
+  - dgamma: Gradient with respect to scale parameter, of shape (C,)
+  - dbeta: Gradient with respect to shift parameter, of shape (C,)
+  """
+  C = dout.shape[-1]
+  dx, dgamma, dbeta = batchnorm_backward_fused(dout.reshape(-1, C), cache)
+  return dx.reshape(dout.shape), dgamma, dbeta
+
+
 def svm_loss(x, y):
   """
   Computes the loss and gradient using for multiclass SVM classification.
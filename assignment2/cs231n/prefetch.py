@@ -0,0 +1,124 @@
+import Queue
+import threading
+
+import numpy as np
+
+
+class BatchPrefetcher(object):
+  """
+  A BatchPrefetcher samples random minibatches of training data on a
+  background thread, so that the fancy-index gather out of the training set
+  (and any data augmentation) overlaps with the forward and backward passes of
+  the model running on the main thread. NumPy releases the GIL while copying
+  array data, so the two threads really do run concurrently.
+
+  Minibatches are gathered into a ring of preallocated buffers, so the gather
+  itself does not allocate memory for the data. A transform, such as the
+  functions in augmentation.py, returns a new array for each minibatch, which
+  is allocated on the background thread. The training data can be a
+  memory-mapped array (see np.load(..., mmap_mode='r')), in which case reads
+  from disk are hidden behind computation as well.
+
+  Example usage:
+
+  prefetcher = BatchPrefetcher(X_train, y_train, batch_size=100, depth=2)
+  for t in xrange(num_iterations):
+    X_batch, y_batch = prefetcher.next()
+    loss, grads = model.loss(X_batch, y_batch)
+    ...
+  prefetcher.close()
+
+  Without a transform, the arrays returned by next() are views into the ring
+  buffers; they remain valid until the following call to next(), after which
+  they may be overwritten by the background thread.
+  """
+
+  def __init__(self, X, y, batch_size, depth=2, transform=None):
+    """
+    Construct a new BatchPrefetcher and start its background thread.
+
+    Inputs:
+    - X: Array of training data, of shape (N, d_1, ..., d_k)
+    - y: Array of training labels, of shape (N,)
+    - batch_size: Number of examples in each minibatch.
+    - depth: Number of minibatches to prepare ahead of the consumer.
+    - transform: Optional function applied to each X minibatch on the
+      background thread, as transform(X_batch, rng=self.rng); see Solver's
+      batch_transform.
+    """
+    if depth < 1:
+      raise ValueError('depth must be positive, got %d' % depth)
+    self.X = X
+    self.y = y
+    self.batch_size = batch_size
+    self.depth = depth
+    self.transform = transform
+
+    # Draw a seed from the global generator so that results are still
+    # reproducible with np.random.seed, without sharing its state between
+    # threads. Both the sampling and the transform use this generator only.
+    self.rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+
+    # One buffer is held by the consumer while depth buffers are filled
+    num_buffers = depth + 1
+    self._X_bufs = [np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+                    for _ in xrange(num_buffers)]
+    self._y_bufs = [np.empty(batch_size, dtype=y.dtype)
+                    for _ in xrange(num_buffers)]
+    self._free = Queue.Queue()
+    self._ready = Queue.Queue()
+    for i in xrange(num_buffers):
+      self._free.put(i)
+    self._in_use = None
+
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._worker)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def _worker(self):
+    """
+    Body of the background thread: wait for a free buffer, fill it with a
+    fresh minibatch, and hand it to the consumer.
+    """
+    num_train = self.X.shape[0]
+    try:
+      while not self._stop.is_set():
+        i = self._free.get()
+        if i is None:
+          break
+        batch_mask = self.rng.choice(num_train, self.batch_size)
+        X_batch = np.take(self.X, batch_mask, axis=0, out=self._X_bufs[i])
+        y_batch = np.take(self.y, batch_mask, axis=0, out=self._y_bufs[i])
+        if self.transform is not None:
+          X_batch = self.transform(X_batch, rng=self.rng)
+        self._ready.put((i, X_batch, y_batch))
+    except Exception as e:
+      # Hand the error to the consumer so that it is raised on the main thread
+      self._ready.put(e)
+
+
+  def next(self):
+    """
+    Return the next prefetched minibatch as a tuple (X_batch, y_batch),
+    waiting for it if it is not ready yet.
+    """
+    if self._in_use is not None:
+      self._free.put(self._in_use)
+      self._in_use = None
+    item = self._ready.get()
+    if isinstance(item, Exception):
+      raise item
+    i, X_batch, y_batch = item
+    self._in_use = i
+    return X_batch, y_batch
+
+
+  def close(self):
+    """
+    Stop the background thread. The prefetcher cannot be used afterwards.
+    """
+    self._stop.set()
+    self._free.put(None)
+    self._thread.join()
@@ -1,6 +1,7 @@
 import numpy as np
 
-from cs231n import optim
+from cs231n import buffers, optim
+from cs231n.prefetch import BatchPrefetcher
 
 
 class Solver(object):
@@ -95,6 +96,23 @@ class Solver(object):
     - batch_size: Size of minibatches used to compute loss and gradient during
       training.
     - num_epochs: The number of epochs to run for during training.
+    - batch_transform: Optional function used for data augmentation. It is
+      called as batch_transform(X_batch, rng=rng) on every training
+      minibatch X_batch of shape (N, d_1, ..., d_k) right after it is
+      gathered from X_train and must return a transformed minibatch of the
+      same shape; see augmentation.py. It must draw its random numbers from
+      the np.random.RandomState rng (np.random itself without prefetching)
+      for training to be reproducible. Validation data and accuracy checks
+      are never transformed.
+    - prefetch: Integer; if positive, training minibatches (including the
+      batch transform) are prepared this many steps ahead on a background
+      thread, overlapping data movement with computation. This also hides
+      disk reads when X_train is a memory-mapped array. Default is 0, which
+      samples each minibatch synchronously.
+    - buffer_pool: Optional BufferPool (see buffers.py). If given, the layers
+      draw their outputs, caches and gradients from it during each training
+      step, and they are all returned to it after the parameter update, so
+      that steady-state steps reuse the same memory instead of allocating.
     - print_every: Integer; training losses will be printed every print_every
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
@@ -112,6 +130,9 @@ class Solver(object):
     self.lr_decay = kwargs.pop('lr_decay', 1.0)
     self.batch_size = kwargs.pop('batch_size', 100)
     self.num_epochs = kwargs.pop('num_epochs', 10)
+    self.batch_transform = kwargs.pop('batch_transform', None)
+    self.prefetch = kwargs.pop('prefetch', 0)
+    self.buffer_pool = kwargs.pop('buffer_pool', None)
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
@@ -142,6 +163,7 @@ class Solver(object):
     self.loss_history = []
     self.train_acc_history = []
     self.val_acc_history = []
+    self._prefetcher = None
 
     # Make a deep copy of the optim_config for each parameter
     self.optim_configs = {}
@@ -150,19 +172,35 @@ class Solver(object):
       self.optim_configs[p] = d
 
 
-  def _step(self):
+  def _sample_batch(self):
     """
-    Make a single gradient update. This is called by train() and should not
-    be called manually.
+    Sample a minibatch of training data and apply the batch transform to it,
+    if there is one. This is called by _step() and should not be called
+    manually.
     """
-    # Make a minibatch of training data
     num_train = self.X_train.shape[0]
     batch_mask = np.random.choice(num_train, self.batch_size)
     X_batch = self.X_train[batch_mask]
     y_batch = self.y_train[batch_mask]
+    if self.batch_transform is not None:
+      X_batch = self.batch_transform(X_batch, rng=np.random)
+    return X_batch, y_batch
+
+
+  def _step(self):
+    """
+    Make a single gradient update. This is called by train() and should not
+    be called manually.
+    """
+    # Make a minibatch of training data
+    if self._prefetcher is not None:
+      X_batch, y_batch = self._prefetcher.next()
+    else:
+      X_batch, y_batch = self._sample_batch()
 
     # Compute loss and gradient
-    loss, grads = self.model.loss(X_batch, y_batch)
+    with buffers.use_buffer_pool(self.buffer_pool):
+      loss, grads = self.model.loss(X_batch, y_batch)
     self.loss_history.append(loss)
 
     # Perform a parameter update
@@ -173,6 +211,10 @@ class Solver(object):
       self.model.params[p] = next_w
       self.optim_configs[p] = next_config
 
+    # Nothing from this step is used any more
+    if self.buffer_pool is not None:
+      self.buffer_pool.reset()
+
 
   def check_accuracy(self, X, y, num_samples=None, batch_size=100):
     """
@@ -223,6 +265,26 @@ class Solver(object):
     iterations_per_epoch = max(num_train / self.batch_size, 1)
     num_iterations = self.num_epochs * iterations_per_epoch
 
+    if self.prefetch > 0:
+      self._prefetcher = BatchPrefetcher(self.X_train, self.y_train,
+                                         self.batch_size, depth=self.prefetch,
+                                         transform=self.batch_transform)
+    try:
+      self._train(num_iterations, iterations_per_epoch)
+    finally:
+      if self._prefetcher is not None:
+        self._prefetcher.close()
+        self._prefetcher = None
+
+    # At the end of training swap the best params into the model
+    self.model.params = self.best_params
+
+
+  def _train(self, num_iterations, iterations_per_epoch):
+    """
+    Run the main optimization loop. This is called by train() and should not
+    be called manually.
+    """
     for t in xrange(num_iterations):
       self._step()
 
@@ -261,6 +323,3 @@ class Solver(object):
           for k, v in self.model.params.iteritems():
             self.best_params[k] = v.copy()
 
-    # At the end of training swap the best params into the model
-    self.model.params = self.best_params
-
@@ -0,0 +1,588 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import Queue
+import re
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from cs231n import layers, fast_layers
+from cs231n.fast_layers import CONV_METHODS, winograd_applicable, _cpu_model
+try:
+  from cs231n import rnn_layers
+except ImportError:
+  rnn_layers = None
+
+
+"""
+This file implements a micro-benchmark suite for the layers in layers.py,
+fast_layers.py (and through it im2col_cython.pyx) and rnn_layers.py. Every
+case runs the forward and backward pass of one implementation of a layer on
+one representative input shape, and records:
+
+- forward_time, backward_time: Best wall time over several trials, in seconds.
+- forward_throughput, backward_throughput: Items processed per second; items
+  are images for image layers and tokens (N * T) for sequence layers.
+- peak_memory: Peak growth of the resident set size over one forward and
+  backward pass, in bytes; this includes the caches and the gradients.
+
+Each case is run in its own process, so that peak memory is measured from a
+clean slate and one case cannot affect another.
+
+The results can be saved as JSON and compared against a stored baseline; a
+metric that is worse than the baseline by more than a relative threshold is
+reported as a regression. From an assignment directory, run for example:
+
+python -m cs231n.benchmark --output baseline.json
+(change some code)
+python -m cs231n.benchmark --baseline baseline.json --filter conv
+
+The second command exits with status 1 if any case regressed.
+"""
+
+
+# Shapes (C, H, W, F, filter_size, stride, pad) of the convolutional layers of
+# PretrainedCNN on 64x64 inputs, and of the convolutional layer of
+# ThreeLayerConvNet with its default hyperparameters.
+CONV_SHAPES = OrderedDict([
+  ('pretrained1', (3, 64, 64, 64, 5, 2, 2)),
+  ('pretrained2', (64, 32, 32, 64, 3, 1, 1)),
+  ('pretrained3', (64, 32, 32, 128, 3, 2, 1)),
+  ('pretrained4', (128, 16, 16, 128, 3, 1, 1)),
+  ('pretrained5', (128, 16, 16, 256, 3, 2, 1)),
+  ('pretrained6', (256, 8, 8, 256, 3, 1, 1)),
+  ('pretrained7', (256, 8, 8, 512, 3, 2, 1)),
+  ('pretrained8', (512, 4, 4, 512, 3, 1, 1)),
+  ('pretrained9', (512, 4, 4, 1024, 3, 2, 1)),
+  ('threelayer', (3, 32, 32, 32, 7, 1, 3)),
+])
+
+# Shapes (C, H, W, pool_size, stride) for pooling layers: the 2x2 pool of
+# ThreeLayerConvNet, and an overlapping 3x3 pool with stride 2.
+POOL_SHAPES = OrderedDict([
+  ('threelayer', (32, 32, 32, 2, 2)),
+  ('overlap', (64, 33, 33, 3, 2)),
+])
+
+# Sizes (T, D, H, V) for the captioning layers of assignment 3: sequences of
+# 16 words from the COCO vocabulary, with 256-dimensional word vectors and a
+# 512-dimensional hidden state.
+CAPTION_SIZES = (16, 256, 512, 1004)
+
+# Changes in peak memory smaller than this many bytes are never regressions,
+# since the resident set size is only measured to the nearest page.
+MEMORY_SLACK = 1 << 20
+
+
+# Maps case names to functions that set up the case; see _add_case.
+BENCHMARK_CASES = OrderedDict()
+
+
+def _add_case(name, setup):
+  """
+  Register a benchmark case.
+
+  Inputs:
+  - name: Unique name of the case, of the form 'group:implementation/shape'.
+  - setup: Function that takes the batch size N and a numpy dtype, and
+    returns a tuple (forward, backward, num_items). forward() runs the forward
+    pass and returns a tuple (out, cache); backward(dout, cache) runs the
+    backward pass, or is None if the case has no backward pass. num_items is
+    the number of items processed by each pass.
+  """
+  BENCHMARK_CASES[name] = setup
+
+
+def _randn(dtype, *shape):
+  return np.random.randn(*shape).astype(dtype)
+
+
+def _conv_case(conv_forward, conv_backward, shape, method=None, groups=1,
+               nhwc=False):
+  C, H, W, F, HH, stride, pad = shape
+  def setup(N, dtype):
+    x = _randn(dtype, N, C, H, W)
+    w = _randn(dtype, F, C / groups, HH, HH)
+    b = _randn(dtype, F)
+    conv_param = {'stride': stride, 'pad': pad, 'groups': groups}
+    if method is not None:
+      conv_param['method'] = method
+    if nhwc:
+      x = fast_layers.to_nhwc(x)
+    return (lambda: conv_forward(x, w, b, conv_param)), conv_backward, N
+  return setup
+
+
+def _pool_case(pool_forward, pool_backward, shape):
+  C, H, W, size, stride = shape
+  def setup(N, dtype):
+    x = _randn(dtype, N, C, H, W)
+    pool_param = {'pool_height': size, 'pool_width': size, 'stride': stride}
+    return (lambda: pool_forward(x, pool_param)), pool_backward, N
+  return setup
+
+
+def _unary_case(layer_forward, layer_backward, shape, *args):
+  def setup(N, dtype):
+    x = _randn(dtype, N, *shape)
+    return (lambda: layer_forward(x, *args)), layer_backward, N
+  return setup
+
+
+def _batchnorm_case(bn_forward, bn_backward, shape, D):
+  def setup(N, dtype):
+    x = _randn(dtype, N, *shape)
+    gamma, beta = _randn(dtype, D), _randn(dtype, D)
+    bn_param = {'mode': 'train'}
+    return (lambda: bn_forward(x, gamma, beta, bn_param)), bn_backward, N
+  return setup
+
+
+def _affine_case(D, M):
+  def setup(N, dtype):
+    x, w, b = _randn(dtype, N, D), _randn(dtype, D, M), _randn(dtype, M)
+    return ((lambda: layers.affine_forward(x, w, b)), layers.affine_backward,
+            N)
+  return setup
+
+
+def _sparse_affine_case(D, M, density):
+  def setup(N, dtype):
+    # ReLU output with the given fraction of nonzero entries, spread over all
+    # examples and features like the output of a trained hidden layer
+    x = _randn(dtype, N, D)
+    x -= np.percentile(x, 100 * (1 - density))
+    x, _ = layers.relu_forward(x)
+    w, b = _randn(dtype, D, M), _randn(dtype, M)
+    # Take the sparse path whatever the density
+    sparse_param = {'threshold': 1.0}
+    forward = lambda: layers.affine_forward(x, w, b, sparse_param)
+    return forward, layers.affine_backward, N
+  return setup
+
+
+def _dropout_case(mask_storage, D):
+  def setup(N, dtype):
+    x = _randn(dtype, N, D)
+    dropout_param = {'p': 0.5, 'mode': 'train', 'mask_storage': mask_storage}
+    return ((lambda: layers.dropout_forward(x, dropout_param)),
+            layers.dropout_backward, N)
+  return setup
+
+
+def _recurrent_case(rnn_forward, rnn_backward, gates):
+  T, D, H, V = CAPTION_SIZES
+  def setup(N, dtype):
+    x, h0 = _randn(dtype, N, T, D), _randn(dtype, N, H)
+    Wx, Wh = _randn(dtype, D, gates * H), _randn(dtype, H, gates * H)
+    b = _randn(dtype, gates * H)
+    return (lambda: rnn_forward(x, h0, Wx, Wh, b)), rnn_backward, N * T
+  return setup
+
+
+def _word_embedding_case():
+  T, D, H, V = CAPTION_SIZES
+  def setup(N, dtype):
+    x = np.random.randint(V, size=(N, T))
+    W = _randn(dtype, V, D)
+    return ((lambda: rnn_layers.word_embedding_forward(x, W)),
+            rnn_layers.word_embedding_backward, N * T)
+  return setup
+
+
+def _temporal_affine_case():
+  T, D, H, V = CAPTION_SIZES
+  def setup(N, dtype):
+    x, w, b = _randn(dtype, N, T, H), _randn(dtype, H, V), _randn(dtype, V)
+    return ((lambda: rnn_layers.temporal_affine_forward(x, w, b)),
+            rnn_layers.temporal_affine_backward, N * T)
+  return setup
+
+
+def _temporal_softmax_case():
+  T, D, H, V = CAPTION_SIZES
+  def setup(N, dtype):
+    x = _randn(dtype, N, T, V)
+    y = np.random.randint(V, size=(N, T))
+    mask = np.random.rand(N, T) < 0.9
+    # The loss returns its gradient directly, so there is no backward pass
+    return (lambda: rnn_layers.temporal_softmax_loss(x, y, mask)), None, N * T
+  return setup
+
+
+def _register_cases():
+  """
+  Register a case for each implementation of each layer that exists in this
+  copy of cs231n, on each of its representative shapes.
+  """
+  # Convolutions through conv_forward_fast, which also covers the Cython
+  # im2col kernels, and through the channels-last implementation
+  for shape_name, shape in CONV_SHAPES.iteritems():
+    C, H, W, F, HH, stride, pad = shape
+    w = np.broadcast_to(0, (F, C, HH, HH))
+    for method in sorted(CONV_METHODS):
+      conv_param = {'stride': stride, 'pad': pad}
+      if method == 'winograd' and not winograd_applicable(w, conv_param):
+        continue
+      if method == 'fft' and stride > 1:
+        continue
+      if method == 'im2col' and (H + 2 * pad - HH) % stride != 0:
+        # conv_forward_im2col only handles windows that tile the input
+        continue
+      _add_case('conv:%s/%s' % (method, shape_name),
+                _conv_case(fast_layers.conv_forward_fast,
+                           fast_layers.conv_backward_fast, shape,
+                           method=method))
+    _add_case('conv:nhwc/%s' % shape_name,
+              _conv_case(fast_layers.conv_forward_nhwc,
+                         fast_layers.conv_backward_nhwc, shape, nhwc=True))
+  _add_case('conv:depthwise/pretrained4',
+            _conv_case(fast_layers.conv_forward_fast,
+                       fast_layers.conv_backward_fast,
+                       CONV_SHAPES['pretrained4'], groups=128))
+  _add_case('conv:grouped/pretrained4',
+            _conv_case(fast_layers.conv_forward_fast,
+                       fast_layers.conv_backward_fast,
+                       CONV_SHAPES['pretrained4'], method='strides', groups=4))
+  if hasattr(layers, 'conv_forward_naive'):
+    # The naive implementation is far too slow for the full-size shapes
+    _add_case('conv:naive/tiny',
+              _conv_case(layers.conv_forward_naive, layers.conv_backward_naive,
+                         (3, 8, 8, 4, 3, 1, 1)))
+
+  # Pooling
+  for shape_name, shape in POOL_SHAPES.iteritems():
+    C, H, W, size, stride = shape
+    pool_impls = [('max_pool:strides', fast_layers.max_pool_forward_strides,
+                   fast_layers.max_pool_backward_strides),
+                  ('avg_pool:strides', fast_layers.avg_pool_forward_strides,
+                   fast_layers.avg_pool_backward_strides)]
+    if size == stride and H % size == 0 and W % size == 0:
+      pool_impls += [('max_pool:reshape', fast_layers.max_pool_forward_reshape,
+                      fast_layers.max_pool_backward_reshape),
+                     ('avg_pool:reshape', fast_layers.avg_pool_forward_reshape,
+                      fast_layers.avg_pool_backward_reshape)]
+    if (H - size) % stride == 0 and (W - size) % stride == 0:
+      pool_impls.append(('max_pool:im2col',
+                         fast_layers.max_pool_forward_im2col,
+                         fast_layers.max_pool_backward_im2col))
+    for impl_name, pool_forward, pool_backward in sorted(pool_impls):
+      _add_case('%s/%s' % (impl_name, shape_name),
+                _pool_case(pool_forward, pool_backward, shape))
+  if hasattr(layers, 'max_pool_forward_naive'):
+    _add_case('max_pool:naive/tiny',
+              _pool_case(layers.max_pool_forward_naive,
+                         layers.max_pool_backward_naive, (4, 8, 8, 2, 2)))
+  _add_case('global_avg_pool/pretrained9',
+            _unary_case(layers.global_avg_pool_forward,
+                        layers.global_avg_pool_backward, (1024, 2, 2)))
+  _add_case('global_max_pool/pretrained9',
+            _unary_case(layers.global_max_pool_forward,
+                        layers.global_max_pool_backward, (1024, 2, 2)))
+
+  # Batch normalization, on the hidden layer of PretrainedCNN and on the
+  # output of its second convolutional layer
+  _add_case('batchnorm:plain/pretrained10',
+            _batchnorm_case(layers.batchnorm_forward,
+                            layers.batchnorm_backward, (512,), 512))
+  if hasattr(layers, 'batchnorm_forward_fused'):
+    _add_case('batchnorm:fused/pretrained10',
+              _batchnorm_case(layers.batchnorm_forward_fused,
+                              layers.batchnorm_backward_fused, (512,), 512))
+  _add_case('spatial_batchnorm:nchw/pretrained2',
+            _batchnorm_case(layers.spatial_batchnorm_forward,
+                            layers.spatial_batchnorm_backward, (64, 32, 32),
+                            64))
+  _add_case('spatial_batchnorm:nhwc/pretrained2',
+            _batchnorm_case(layers.spatial_batchnorm_forward_nhwc,
+                            layers.spatial_batchnorm_backward_nhwc,
+                            (32, 32, 64), 64))
+
+  # Fully-connected layers, on the hidden layer of PretrainedCNN
+  _add_case('affine/pretrained10', _affine_case(1024 * 2 * 2, 512))
+  for percent in (10, 50):
+    _add_case('affine:sparse%d/pretrained10' % percent,
+              _sparse_affine_case(1024 * 2 * 2, 512, percent / 100.0))
+  _add_case('relu/pretrained2',
+            _unary_case(layers.relu_forward, layers.relu_backward,
+                        (64, 32, 32)))
+  if hasattr(layers, 'dropout_forward'):
+    for mask_storage in ('full', 'packed', 'seed'):
+      _add_case('dropout:%s/fc4096' % mask_storage,
+                _dropout_case(mask_storage, 4096))
+
+  # Captioning layers
+  if rnn_layers is not None:
+    _add_case('rnn/caption', _recurrent_case(rnn_layers.rnn_forward,
+                                             rnn_layers.rnn_backward, 1))
+    _add_case('lstm/caption', _recurrent_case(rnn_layers.lstm_forward,
+                                              rnn_layers.lstm_backward, 4))
+    _add_case('word_embedding/caption', _word_embedding_case())
+    _add_case('temporal_affine/caption', _temporal_affine_case())
+    _add_case('temporal_softmax_loss/caption', _temporal_softmax_case())
+
+
+_register_cases()
+
+
+def _rss_bytes(field):
+  """
+  Return the field 'VmRSS' (current) or 'VmHWM' (peak) resident set size of
+  this process in bytes, or None if it is not available on this platform.
+  """
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError):
+    pass
+  return None
+
+
+def _reset_peak_rss():
+  """
+  Reset the peak resident set size of this process to its current value, if
+  the platform allows it.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except (IOError, OSError):
+    pass
+
+
+def run_case(name, batch_size=16, dtype=np.float32, num_trials=5):
+  """
+  Run one benchmark case in the current process.
+
+  Inputs:
+  - name: Name of a case in BENCHMARK_CASES.
+  - batch_size: Batch size N of the inputs.
+  - dtype: numpy datatype of the inputs.
+  - num_trials: Number of times to run the forward and backward pass; the
+    best time is reported.
+
+  Returns a dictionary with the metrics described at the top of this file;
+  metrics of a missing backward pass are None.
+  """
+  forward, backward, num_items = BENCHMARK_CASES[name](batch_size, dtype)
+
+  # Measure peak memory on the first pass, before anything has been cached.
+  # dout is allocated by the benchmark rather than the layer, so it is not
+  # counted.
+  _reset_peak_rss()
+  rss_start = _rss_bytes('VmRSS')
+  out, cache = forward()
+  dout_bytes = 0
+  if backward is not None:
+    dout = np.random.randn(*out.shape).astype(out.dtype)
+    dout_bytes = dout.nbytes
+    backward(dout, cache)
+  rss_peak = _rss_bytes('VmHWM')
+  peak_memory = None
+  if rss_start is not None and rss_peak is not None:
+    peak_memory = max(0, rss_peak - rss_start - dout_bytes)
+  del out, cache
+
+  forward_time, backward_time = None, None
+  for _ in xrange(num_trials):
+    t0 = time.time()
+    out, cache = forward()
+    t1 = time.time()
+    forward_time = min(forward_time or np.inf, t1 - t0)
+    if backward is not None:
+      t0 = time.time()
+      backward(dout, cache)
+      t1 = time.time()
+      backward_time = min(backward_time or np.inf, t1 - t0)
+    del out, cache
+
+  result = {
+    'num_items': num_items,
+    'forward_time': forward_time,
+    'forward_throughput': num_items / forward_time if forward_time else None,
+    'backward_time': backward_time,
+    'backward_throughput': None,
+    'peak_memory': peak_memory,
+  }
+  if backward_time:
+    result['backward_throughput'] = num_items / backward_time
+  return result
+
+
+def _run_case_in_child(queue, name, batch_size, dtype, num_trials, seed):
+  np.random.seed(seed)
+  try:
+    queue.put(run_case(name, batch_size, dtype, num_trials))
+  except Exception as e:
+    queue.put('%s: %s' % (type(e).__name__, e))
+
+
+def run_benchmarks(pattern=None, batch_size=16, dtype=np.float32, num_trials=5,
+                   seed=0, verbose=True):
+  """
+  Run every benchmark case whose name matches a regular expression, each in
+  a separate process.
+
+  Inputs:
+  - pattern: Regular expression searched for in case names; None runs all
+    cases.
+  - batch_size, dtype, num_trials: As for run_case.
+  - seed: Seed for the random inputs of each case.
+  - verbose: If True, print the results as they come in.
+
+  Returns a dictionary with the keys:
+  - 'machine': Dictionary describing the machine and software.
+  - 'settings': Dictionary of the settings of the run.
+  - 'results': Ordered dictionary mapping case names to their metrics.
+  - 'errors': Dictionary mapping the names of cases that failed to their
+    error messages.
+  """
+  machine = {
+    'cpu': _cpu_model(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'cython_im2col': fast_layers.im2col_cython.__module__ != 'cs231n.im2col',
+  }
+  settings = {
+    'batch_size': batch_size,
+    'dtype': np.dtype(dtype).name,
+    'num_trials': num_trials,
+    'seed': seed,
+  }
+  results, errors = OrderedDict(), {}
+  for name in BENCHMARK_CASES:
+    if pattern is not None and not re.search(pattern, name):
+      continue
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_in_child,
+        args=(queue, name, batch_size, dtype, num_trials, seed))
+    process.start()
+    process.join()
+    try:
+      result = queue.get_nowait()
+    except Queue.Empty:
+      result = 'process exited with code %s' % process.exitcode
+    if isinstance(result, dict):
+      results[name] = result
+      if verbose:
+        print _format_result(name, result)
+    else:
+      errors[name] = result
+      if verbose:
+        print '%-40s failed: %s' % (name, result)
+  return {'machine': machine, 'settings': settings, 'results': results,
+          'errors': errors}
+
+
+def _format_result(name, result):
+  """ Return a one-line summary of the metrics of one case. """
+  def fmt_time(t):
+    return '%10.3f ms' % (1000 * t) if t is not None else '%13s' % '-'
+  memory = result['peak_memory']
+  memory = '%9.1f MB' % (memory / 1e6) if memory is not None else '%12s' % '-'
+  return '%-40s fwd %s  bwd %s  %12.0f items/s  peak %s' % (
+      name, fmt_time(result['forward_time']), fmt_time(result['backward_time']),
+      result['forward_throughput'], memory)
+
+
+def compare(current, baseline, time_threshold=0.1, memory_threshold=0.1):
+  """
+  Compare the results of a benchmark run against a baseline run.
+
+  A time is a regression if it is more than a fraction time_threshold slower
+  than in the baseline, and peak memory is a regression if it is more than a
+  fraction memory_threshold larger (and by more than MEMORY_SLACK bytes).
+  Cases that are missing from either run are ignored.
+
+  Inputs:
+  - current, baseline: Dictionaries returned by run_benchmarks.
+  - time_threshold: Relative slowdown allowed before a time is a regression.
+  - memory_threshold: Relative growth allowed before peak memory is a
+    regression.
+
+  Returns a list of tuples (name, metric, baseline_value, current_value) for
+  every regression, in the order of the cases.
+  """
+  thresholds = [('forward_time', time_threshold),
+                ('backward_time', time_threshold),
+                ('peak_memory', memory_threshold)]
+  regressions = []
+  for name, result in current['results'].iteritems():
+    base_result = baseline['results'].get(name)
+    if base_result is None:
+      continue
+    for metric, threshold in thresholds:
+      old, new = base_result.get(metric), result.get(metric)
+      if old is None or new is None:
+        continue
+      if metric == 'peak_memory' and new - old <= MEMORY_SLACK:
+        continue
+      if new > old * (1 + threshold):
+        regressions.append((name, metric, old, new))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description='Benchmark the cs231n layers and compare to a baseline.')
+  parser.add_argument('--filter', default=None,
+                      help='Only run cases whose names match this regex')
+  parser.add_argument('--list', action='store_true',
+                      help='List the benchmark cases and exit')
+  parser.add_argument('--batch-size', type=int, default=16)
+  parser.add_argument('--dtype', default='float32')
+  parser.add_argument('--num-trials', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None,
+                      help='Write the results to this JSON file')
+  parser.add_argument('--baseline', default=None,
+                      help='Compare the results to this JSON file')
+  parser.add_argument('--time-threshold', type=float, default=0.1,
+                      help='Relative slowdown that counts as a regression')
+  parser.add_argument('--memory-threshold', type=float, default=0.1,
+                      help='Relative memory growth that counts as a regression')
+  args = parser.parse_args(argv)
+
+  if args.list:
+    for name in BENCHMARK_CASES:
+      if args.filter is None or re.search(args.filter, name):
+        print name
+    return 0
+
+  current = run_benchmarks(args.filter, batch_size=args.batch_size,
+                           dtype=np.dtype(args.dtype),
+                           num_trials=args.num_trials, seed=args.seed)
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(current, f, indent=2)
+
+  status = 1 if current['errors'] else 0
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f, object_pairs_hook=OrderedDict)
+    if baseline['machine'] != current['machine']:
+      print 'Warning: the baseline was recorded on a different machine:'
+      print '  %s' % baseline['machine']
+    if baseline['settings'] != current['settings']:
+      print 'Warning: the baseline was recorded with different settings:'
+      print '  %s' % baseline['settings']
+    regressions = compare(current, baseline, args.time_threshold,
+                          args.memory_threshold)
+    for name, metric, old, new in regressions:
+      print 'REGRESSION %-40s %-14s %.4g -> %.4g (%+.1f%%)' % (
+          name, metric, old, new, 100.0 * (new - old) / old)
+    if regressions:
+      status = 1
+    else:
+      print 'No regressions against %s' % args.baseline
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,235 @@
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+"""
+This file implements an opt-in pool of reusable numpy buffers for the
+outputs, gradients and caches of layers.
+
+Every forward and backward pass normally allocates fresh arrays. Large arrays
+are allocated directly from the operating system with mmap and are returned
+with munmap when they are freed, so every training step pays for mapping and
+page faulting the same large buffers again. A BufferPool keeps those buffers
+around instead: arrays are keyed by (shape, dtype), and an array that is
+returned to the pool is handed out again the next time an array of the same
+shape and dtype is requested. Since every training step allocates the same
+shapes in the same order, steady-state steps do almost no large allocations.
+
+Layers allocate through the module-level functions empty and zeros, which use
+the active pool if there is one and fall back to numpy otherwise, so nothing
+changes unless a pool is activated:
+
+pool = BufferPool()
+with use_buffer_pool(pool):
+  loss, grads = model.loss(X_batch, y_batch)
+(use grads to update the parameters)
+pool.reset()
+
+Buffers come back to the pool in two ways. A backward pass releases private
+temporaries of its cache (such as an im2col matrix) as soon as it no longer
+needs them, and reset returns every buffer handed out since the last reset.
+After reset, all arrays that the layers produced during the step (outputs,
+caches and gradients) may be overwritten, so reset must only be called once
+they are no longer needed. The Solver does this for you if it is given a
+buffer_pool.
+"""
+
+
+class BufferPool(object):
+  """
+  A pool of reusable numpy arrays, keyed by shape and dtype.
+
+  Arrays smaller than min_bytes are cheap to allocate and are not pooled.
+  """
+
+  def __init__(self, min_bytes=1 << 16):
+    """
+    Construct a new BufferPool.
+
+    Inputs:
+    - min_bytes: Arrays smaller than this many bytes are allocated directly
+      with numpy rather than from the pool.
+    """
+    self.min_bytes = min_bytes
+    # Maps (shape, dtype) to a list of arrays that can be handed out
+    self._free = defaultdict(list)
+    # Maps id(array) to (array, key) for arrays that are handed out. These are
+    # strong references, so that buffers the layers drop before the end of a
+    # step are not freed; they all come back with reset.
+    self._in_use = {}
+    self._free_bytes = 0
+    self._in_use_bytes = 0
+    self.reset_stats()
+
+
+  def reset_stats(self):
+    """
+    Reset the hit and miss counters and the high-water mark.
+    """
+    self._hits = 0
+    self._misses = 0
+    self._high_water_bytes = self._free_bytes + self._in_use_bytes
+
+
+  def empty(self, shape, dtype=np.float64):
+    """
+    Return an uninitialized C-contiguous array of the given shape and dtype,
+    reusing a pooled array if there is one.
+    """
+    if isinstance(shape, (int, long)):
+      shape = (shape,)
+    shape, dtype = tuple(shape), np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if nbytes < self.min_bytes:
+      return np.empty(shape, dtype=dtype)
+
+    key = (shape, dtype.str)
+    free = self._free.get(key)
+    if free:
+      array = free.pop()
+      self._free_bytes -= nbytes
+      self._hits += 1
+    else:
+      array = np.empty(shape, dtype=dtype)
+      self._misses += 1
+    self._in_use[id(array)] = (array, key)
+    self._in_use_bytes += nbytes
+    self._high_water_bytes = max(self._high_water_bytes,
+                                 self._free_bytes + self._in_use_bytes)
+    return array
+
+
+  def zeros(self, shape, dtype=np.float64):
+    """
+    Return an array of zeros of the given shape and dtype, reusing a pooled
+    array if there is one.
+    """
+    array = self.empty(shape, dtype)
+    array.fill(0)
+    return array
+
+
+  def _give_back(self, array_id):
+    array, key = self._in_use.pop(array_id)
+    self._in_use_bytes -= array.nbytes
+    # Undo any in-place reshape by the user of the array
+    array.shape = key[0]
+    self._free[key].append(array)
+    self._free_bytes += array.nbytes
+
+
+  def release(self, *arrays):
+    """
+    Return arrays to the pool, so that they can be handed out again; the
+    arrays must not be used afterwards. Views of a pooled array release the
+    whole array. Arrays that did not come from the pool, and None, are
+    ignored. Do not release the contents of a cache from a backward pass,
+    since backward may be run again on the same cache (as when checking
+    gradients); they go back to the pool on reset.
+    """
+    for array in arrays:
+      while isinstance(array, np.ndarray):
+        entry = self._in_use.get(id(array))
+        if entry is not None and entry[0] is array:
+          self._give_back(id(array))
+          break
+        array = array.base
+
+
+  def reset(self):
+    """
+    Return every array handed out since the last reset to the pool. Arrays
+    are only reused after they are released or reset, so a pool that is
+    never reset keeps every array it hands out.
+    """
+    for array_id in self._in_use.keys():
+      self._give_back(array_id)
+
+
+  def clear(self):
+    """
+    Drop all pooled arrays that are not in use, freeing their memory.
+    """
+    self._free.clear()
+    self._free_bytes = 0
+
+
+  def stats(self):
+    """
+    Return a dictionary of statistics about the pool:
+    - hits: Number of requests served with a pooled array.
+    - misses: Number of requests that allocated a new array.
+    - hit_rate: hits / (hits + misses), or None if there were no requests.
+    - in_use_bytes: Bytes of pooled arrays that are currently handed out.
+    - free_bytes: Bytes of pooled arrays that are waiting to be reused.
+    - high_water_bytes: Largest value of in_use_bytes + free_bytes, that is,
+      the most memory that the pool has held at once.
+    The counters cover the time since the pool was created or since the last
+    call to reset_stats.
+    """
+    requests = self._hits + self._misses
+    return {
+      'hits': self._hits,
+      'misses': self._misses,
+      'hit_rate': float(self._hits) / requests if requests else None,
+      'in_use_bytes': self._in_use_bytes,
+      'free_bytes': self._free_bytes,
+      'high_water_bytes': self._high_water_bytes,
+    }
+
+
+# The pool used by empty, zeros and release; None disables pooling.
+_active_pool = None
+
+
+def get_buffer_pool():
+  """ Return the active BufferPool, or None. """
+  return _active_pool
+
+
+def set_buffer_pool(pool):
+  """
+  Make pool the active BufferPool; None disables pooling. Returns the pool
+  that was active before.
+  """
+  global _active_pool
+  previous, _active_pool = _active_pool, pool
+  return previous
+
+
+@contextmanager
+def use_buffer_pool(pool):
+  """
+  Context manager that makes pool the active BufferPool inside a with
+  statement. Passing None leaves pooling disabled.
+  """
+  previous = set_buffer_pool(pool)
+  try:
+    yield pool
+  finally:
+    set_buffer_pool(previous)
+
+
+def empty(shape, dtype=np.float64):
+  """ np.empty, drawing from the active BufferPool if there is one. """
+  if _active_pool is None:
+    return np.empty(shape, dtype=dtype)
+  return _active_pool.empty(shape, dtype)
+
+
+def zeros(shape, dtype=np.float64):
+  """ np.zeros, drawing from the active BufferPool if there is one. """
+  if _active_pool is None:
+    return np.zeros(shape, dtype=dtype)
+  return _active_pool.zeros(shape, dtype)
+
+
+def release(*arrays):
+  """
+  Return arrays to the active BufferPool, if there is one; see
+  BufferPool.release.
+  """
+  if _active_pool is not None:
+    _active_pool.release(*arrays)
@@ -1,6 +1,6 @@
 import numpy as np
 
-from cs231n import optim
+from cs231n import buffers, optim
 from cs231n.coco_utils import sample_coco_minibatch
 
 
@@ -81,6 +81,10 @@ class CaptioningSolver(object):
     - batch_size: Size of minibatches used to compute loss and gradient during
       training.
     - num_epochs: The number of epochs to run for during training.
+    - buffer_pool: Optional BufferPool (see buffers.py). If given, the layers
+      draw their outputs, caches and gradients from it during each training
+      step, and they are all returned to it after the parameter update, so
+      that steady-state steps reuse the same memory instead of allocating.
     - print_every: Integer; training losses will be printed every print_every
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
@@ -95,6 +99,7 @@ class CaptioningSolver(object):
     self.lr_decay = kwargs.pop('lr_decay', 1.0)
     self.batch_size = kwargs.pop('batch_size', 100)
     self.num_epochs = kwargs.pop('num_epochs', 10)
+    self.buffer_pool = kwargs.pop('buffer_pool', None)
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
@@ -145,7 +150,8 @@ class CaptioningSolver(object):
     captions, features, urls = minibatch
 
     # Compute loss and gradient
-    loss, grads = self.model.loss(features, captions)
+    with buffers.use_buffer_pool(self.buffer_pool):
+      loss, grads = self.model.loss(features, captions)
     self.loss_history.append(loss)
 
     # Perform a parameter update
@@ -156,6 +162,10 @@ class CaptioningSolver(object):
       self.model.params[p] = next_w
       self.optim_configs[p] = next_config
 
+    # Nothing from this step is used any more
+    if self.buffer_pool is not None:
+      self.buffer_pool.reset()
+
   
   # TODO: This does nothing right now; maybe implement BLEU?
   def check_accuracy(self, X, y, num_samples=None, batch_size=100):
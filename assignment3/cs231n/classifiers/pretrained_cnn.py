@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 import h5py
 
@@ -7,7 +9,37 @@ from cs231n.layer_utils import *
 
 
 class PretrainedCNN(object):
-  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None):
+  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None,
+               layout='NCHW', checkpoint=None, sparse_threshold=None):
+    # layout is the memory layout used inside the convolutional layers, either
+    # 'NCHW' or 'NHWC' (channels-last). Inputs, outputs, parameters and
+    # gradients of forward and backward are NCHW either way; with 'NHWC' they
+    # are converted once where a range of layers enters and leaves the
+    # convolutional layers.
+    #
+    # checkpoint reduces the memory held between forward and backward by
+    # recomputing activations during the backward pass:
+    # - None: keep every cache (fastest).
+    # - 'conv': each convolution keeps only its input rather than its im2col
+    #   matrix, and rebuilds the matrix in the backward pass.
+    # - 'layers': each [conv - spatial batchnorm - relu] block keeps only its
+    #   input, and is run forward again in the backward pass.
+    #
+    # If sparse_threshold is not None, the ReLU of the fully-connected hidden
+    # layer and the layer producing scores take their sparse paths whenever
+    # the density of the hidden activations is below sparse_threshold; see
+    # relu_forward, affine_forward and the sparsity_stats method.
+    if layout not in ('NCHW', 'NHWC'):
+      raise ValueError('Invalid layout "%s"' % layout)
+    if checkpoint not in (None, 'conv', 'layers'):
+      raise ValueError('Invalid checkpoint "%s"' % checkpoint)
+    self.layout = layout
+    self.checkpoint = checkpoint
+    # Set on the copies made by fold_batchnorm
+    self.folded = False
+    self.sparse_param = None
+    if sparse_threshold is not None:
+      self.sparse_param = {'threshold': sparse_threshold}
     self.dtype = dtype
     self.conv_params = []
     self.input_size = input_size
@@ -24,6 +56,8 @@ class PretrainedCNN(object):
     self.conv_params.append({'stride': 2, 'pad': 1})
     self.conv_params.append({'stride': 1, 'pad': 1})
     self.conv_params.append({'stride': 2, 'pad': 1})
+    for conv_param in self.conv_params:
+      conv_param['checkpoint'] = checkpoint == 'conv'
 
     self.filter_sizes = [5, 3, 3, 3, 3, 3, 3, 3, 3]
     self.num_filters = [64, 64, 128, 128, 256, 256, 512, 512, 1024]
@@ -117,6 +151,9 @@ class PretrainedCNN(object):
     [affine - batchnorm - relu] (There is one of these)
     [affine] (There is one of these)
 
+    In a network returned by fold_batchnorm the batchnorm layers are folded
+    away, and the blocks are [conv - relu] and [affine - relu] instead.
+
     Inputs:
     - X: The input to the starting layer. If start=0, then this should be an
       array of shape (N, C, 64, 64).
@@ -137,29 +174,55 @@ class PretrainedCNN(object):
     if end is None: end = len(self.conv_params) + 1
     layer_caches = []
 
+    nhwc = self.layout == 'NHWC'
+    num_conv = len(self.conv_params)
+
     prev_a = X
+    if nhwc and start < num_conv:
+      prev_a = to_nhwc(prev_a)
     for i in xrange(start, end + 1):
       i1 = i + 1
       if 0 <= i < len(self.conv_params):
         # This is a conv layer
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
         conv_param = self.conv_params[i]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-
-        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
+        if self.folded:
+          if nhwc:
+            layer_forward = conv_relu_forward_nhwc
+          else:
+            layer_forward = conv_relu_forward
+          args = (w, b, conv_param)
+        else:
+          gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+          bn_param = self.bn_params[i]
+          bn_param['mode'] = mode
+          if nhwc:
+            layer_forward = conv_bn_relu_forward_nhwc
+          else:
+            layer_forward = conv_bn_relu_forward
+          args = (w, b, gamma, beta, conv_param, bn_param)
+        if self.checkpoint == 'layers':
+          next_a, cache = checkpoint_forward(layer_forward, prev_a, *args)
+        else:
+          next_a, cache = layer_forward(prev_a, *args)
       elif i == len(self.conv_params):
         # This is the fully-connected hidden layer
+        if nhwc and i > start:
+          prev_a = from_nhwc(prev_a)
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-        next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
+        if self.folded:
+          next_a, cache = affine_relu_forward(prev_a, w, b,
+                                              out_sparse_param=self.sparse_param)
+        else:
+          gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+          bn_param = self.bn_params[i]
+          bn_param['mode'] = mode
+          next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param,
+                                                 out_sparse_param=self.sparse_param)
       elif i == len(self.conv_params) + 1:
         # This is the last fully-connected layer that produces scores
         w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        next_a, cache = affine_forward(prev_a, w, b)
+        next_a, cache = affine_forward(prev_a, w, b, self.sparse_param)
       else:
         raise ValueError('Invalid layer index %d' % i)
 
@@ -167,6 +230,8 @@ class PretrainedCNN(object):
       prev_a = next_a
 
     out = prev_a
+    if nhwc and end < num_conv:
+      out = from_nhwc(out)
     cache = (start, end, layer_caches)
     return out, cache
 
@@ -192,7 +257,12 @@ class PretrainedCNN(object):
       of self.params, and grads[k] and self.params[k] will have the same shape.
     """
     start, end, layer_caches = cache
+    nhwc = self.layout == 'NHWC'
+    num_conv = len(self.conv_params)
+
     dnext_a = dout
+    if nhwc and end < num_conv:
+      dnext_a = to_nhwc(dnext_a)
     grads = {}
     for i in reversed(range(start, end + 1)):
       i1 = i + 1
@@ -203,25 +273,45 @@ class PretrainedCNN(object):
         grads['b%d' % i1] = db
       elif i == len(self.conv_params):
         # This is the fully-connected hidden layer
-        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
+        if self.folded:
+          dprev_a, dw, db = affine_relu_backward(dnext_a, layer_caches.pop())
+        else:
+          temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
+          dprev_a, dw, db, dgamma, dbeta = temp
+          grads['gamma%d' % i1] = dgamma
+          grads['beta%d' % i1] = dbeta
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
-        grads['gamma%d' % i1] = dgamma
-        grads['beta%d' % i1] = dbeta
       elif 0 <= i < len(self.conv_params):
         # This is a conv layer
-        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
+        if nhwc and i == num_conv - 1 and i < end:
+          dnext_a = to_nhwc(dnext_a)
+        if self.folded:
+          if nhwc:
+            layer_backward = conv_relu_backward_nhwc
+          else:
+            layer_backward = conv_relu_backward
+        elif nhwc:
+          layer_backward = conv_bn_relu_backward_nhwc
+        else:
+          layer_backward = conv_bn_relu_backward
+        if self.checkpoint == 'layers':
+          temp = checkpoint_backward(layer_backward, dnext_a, layer_caches.pop())
+        else:
+          temp = layer_backward(dnext_a, layer_caches.pop())
+        dprev_a, dw, db = temp[:3]
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
-        grads['gamma%d' % i1] = dgamma
-        grads['beta%d' % i1] = dbeta
+        if not self.folded:
+          grads['gamma%d' % i1] = temp[3]
+          grads['beta%d' % i1] = temp[4]
       else:
         raise ValueError('Invalid layer index %d' % i)
       dnext_a = dprev_a
 
     dX = dnext_a
+    if nhwc and start < num_conv:
+      dX = from_nhwc(dX)
     return dX, grads
 
 
@@ -250,3 +340,46 @@ class PretrainedCNN(object):
     dX, grads = self.backward(dscores, cache)
     return loss, grads
 
+
+
+  def fold_batchnorm(self):
+    """
+    Return a copy of this network for inference, in which each batchnorm
+    layer is folded into the weights and biases of the conv or affine layer
+    before it, using the running averages in self.bn_params (see
+    layer_utils.fold_batchnorm). The copy computes the same scores as this
+    network in test mode, without the nine spatial batchnorm passes and the
+    batchnorm pass of the hidden layer. Its params have no gamma and beta
+    entries, and it computes the test-mode function in training mode too, so
+    it should not be trained further. This network is not modified.
+    """
+    model = copy.copy(self)
+    model.folded = True
+    model.conv_params = copy.deepcopy(self.conv_params)
+    model.bn_params = []
+    if self.sparse_param is not None:
+      model.sparse_param = {'threshold': self.sparse_param['threshold']}
+
+    model.params = {}
+    for k, v in self.params.iteritems():
+      if not k.startswith('gamma') and not k.startswith('beta'):
+        model.params[k] = v.copy()
+    for i, bn_param in enumerate(self.bn_params):
+      i1 = i + 1
+      w, b = fold_batchnorm(self.params['W%d' % i1], self.params['b%d' % i1],
+                            self.params['gamma%d' % i1],
+                            self.params['beta%d' % i1], bn_param)
+      model.params['W%d' % i1], model.params['b%d' % i1] = w, b
+    return model
+
+
+  def sparsity_stats(self):
+    """
+    Return the sparsity statistics of the hidden activations, as measured by
+    the ReLU of the fully-connected hidden layer and the layer producing
+    scores (see layers.sparsity_stats), or None if the network was
+    constructed without sparse_threshold.
+    """
+    if self.sparse_param is None:
+      return None
+    return sparsity_stats(self.sparse_param)
@@ -1,11 +1,44 @@
+import collections
+
 import numpy as np
 
+from cs231n import buffers
 
-def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+
+# The index tables below only depend on the shapes involved, and the same
+# shapes come up on every forward and backward pass, so we keep the most
+# recently used tables in a bounded LRU cache. Cached arrays are read-only
+# since they are shared between all callers.
+IM2COL_INDEX_CACHE_SIZE = 32
+_im2col_index_cache = collections.OrderedDict()
+
+
+def _cached(key, build):
+  """
+  Return the cached value for key, calling build() to create it on a miss.
+  """
+  try:
+    value = _im2col_index_cache.pop(key)
+  except KeyError:
+    value = build()
+    for a in value:
+      a.flags.writeable = False
+    while len(_im2col_index_cache) >= IM2COL_INDEX_CACHE_SIZE:
+      _im2col_index_cache.popitem(last=False)
+  _im2col_index_cache[key] = value
+  return value
+
+
+def clear_im2col_index_cache():
+  """ Drop all cached im2col index tables. """
+  _im2col_index_cache.clear()
+
+
+def _build_im2col_indices(x_shape, field_height, field_width, padding, stride):
   # First figure out what the size of the output should be
   N, C, H, W = x_shape
   assert (H + 2 * padding - field_height) % stride == 0
-  assert (W + 2 * padding - field_height) % stride == 0
+  assert (W + 2 * padding - field_width) % stride == 0
   out_height = (H + 2 * padding - field_height) / stride + 1
   out_width = (W + 2 * padding - field_width) / stride + 1
 
@@ -22,12 +55,56 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
   return (k, i, j)
 
 
-def im2col_indices(x, field_height, field_width, padding=1, stride=1):
-  """ An implementation of im2col based on some fancy indexing """
+def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+  """
+  Return read-only index arrays (k, i, j) such that x_padded[:, k, i, j]
+  gathers the patches of a padded input of shape x_shape. The arrays do not
+  depend on the batch size, so they are shared by all N.
+  """
+  key = ('kij', tuple(x_shape[1:]), field_height, field_width, padding, stride)
+  return _cached(key, lambda: _build_im2col_indices(
+      x_shape, field_height, field_width, padding, stride))
+
+
+def get_im2col_flat_indices(x_shape, field_height, field_width, padding=1,
+                            stride=1):
+  """
+  Return a read-only array of flat indices into the raveled padded input,
+  of shape (C * field_height * field_width, out_height * out_width * N),
+  such that x_padded.ravel()[flat] is the output of im2col_indices. The
+  indices are int32 unless the padded input is too large for it.
+  """
+  def build():
+    N, C, H, W = x_shape
+    H_padded, W_padded = H + 2 * padding, W + 2 * padding
+    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+                                 stride)
+    size = N * C * H_padded * W_padded
+    dtype = np.int32 if size <= np.iinfo(np.int32).max else np.int64
+    offsets = ((k * H_padded + i) * W_padded + j).astype(dtype)
+    image_offsets = np.arange(N, dtype=dtype) * (C * H_padded * W_padded)
+    flat = offsets[:, :, None] + image_offsets[None, None, :]
+    return (flat.reshape(offsets.shape[0], -1),)
+
+  key = ('flat', tuple(x_shape), field_height, field_width, padding, stride)
+  return _cached(key, build)[0]
+
+
+def im2col_indices(x, field_height, field_width, padding=1, stride=1,
+                   flat=False):
+  """
+  An implementation of im2col based on some fancy indexing. If flat is True,
+  the patches are gathered with a single np.take on cached flat indices.
+  """
   # Zero-pad the input
   p = padding
   x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
 
+  if flat:
+    flat_idx = get_im2col_flat_indices(x.shape, field_height, field_width,
+                                       padding, stride)
+    return np.take(x_padded, flat_idx)
+
   k, i, j = get_im2col_indices(x.shape, field_height, field_width, padding,
                                stride)
 
@@ -38,18 +115,117 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
-                   stride=1):
-  """ An implementation of col2im based on fancy indexing and np.add.at """
+                   stride=1, flat=False):
+  """
+  An implementation of col2im based on fancy indexing and np.add.at. If flat
+  is True, the scatter is done with np.bincount on cached flat indices, which
+  is much faster than np.add.at.
+  """
   N, C, H, W = x_shape
   H_padded, W_padded = H + 2 * padding, W + 2 * padding
-  x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-  k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                               stride)
-  cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-  cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-  np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+  if flat:
+    flat_idx = get_im2col_flat_indices(x_shape, field_height, field_width,
+                                       padding, stride)
+    x_padded = np.bincount(flat_idx.ravel(), weights=cols.ravel(),
+                           minlength=N * C * H_padded * W_padded)
+    x_padded = x_padded.astype(cols.dtype, copy=False)
+    x_padded = x_padded.reshape(N, C, H_padded, W_padded)
+  else:
+    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
+    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+                                 stride)
+    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
+    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
+    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
   if padding == 0:
     return x_padded
   return x_padded[:, :, padding:-padding, padding:-padding]
 
+
 pass
+
+
+"""
+Pure numpy versions of the kernels in im2col_cython.pyx, with the same
+signatures and memory layouts. fast_layers uses these when the Cython
+extension has not been built. Patches are gathered through a zero-copy
+strided view of the padded input, and the col2im scatters loop only over
+the field_height * field_width kernel offsets, accumulating a whole strided
+slice of the output at a time, so both run at close to the speed of the
+Cython versions.
+"""
+
+
+def _patch_view(x_padded, field_height, field_width, out_height, out_width,
+                stride, dilation=1):
+  """
+  Return a read-only strided view of shape
+  (C, field_height, field_width, out_height, out_width, N) whose element
+  [c, ii, jj, yy, xx, n] is
+  x_padded[n, c, stride * yy + dilation * ii, stride * xx + dilation * jj].
+  """
+  sN, sC, sH, sW = x_padded.strides
+  N, C = x_padded.shape[:2]
+  shape = (C, field_height, field_width, out_height, out_width, N)
+  strides = (sC, dilation * sH, dilation * sW, stride * sH, stride * sW, sN)
+  view = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                         strides=strides)
+  view.flags.writeable = False
+  return view
+
+
+def im2col_strided(x, field_height, field_width, padding, stride, dilation=1):
+  """
+  Numpy equivalent of im2col_cython: returns cols of shape
+  (C * field_height * field_width, out_height * out_width * N).
+  """
+  N, C, H, W = x.shape
+  out_height = (H + 2 * padding - dilation * (field_height - 1) - 1) / stride + 1
+  out_width = (W + 2 * padding - dilation * (field_width - 1) - 1) / stride + 1
+  p = padding
+  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+  view = _patch_view(x_padded, field_height, field_width, out_height,
+                     out_width, stride, dilation)
+  cols = np.ascontiguousarray(view)
+  cols.shape = (C * field_height * field_width, -1)
+  return cols
+
+
+def col2im_strided(cols, N, C, H, W, field_height, field_width, padding,
+                   stride, dilation=1):
+  """
+  Numpy equivalent of col2im_cython: the adjoint of im2col_strided.
+  """
+  out_height = (H + 2 * padding - dilation * (field_height - 1) - 1) / stride + 1
+  out_width = (W + 2 * padding - dilation * (field_width - 1) - 1) / stride + 1
+  cols = cols.reshape(C, field_height, field_width, out_height, out_width, N)
+  x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
+                      dtype=cols.dtype)
+  for ii in xrange(field_height):
+    for jj in xrange(field_width):
+      y0, x0 = dilation * ii, dilation * jj
+      x_padded[:, :, y0:y0 + stride * out_height:stride,
+               x0:x0 + stride * out_width:stride] += \
+          cols[:, ii, jj].transpose(3, 0, 1, 2)
+  if padding > 0:
+    return x_padded[:, :, padding:-padding, padding:-padding]
+  return x_padded
+
+
+def col2im_6d_strided(cols, N, C, H, W, HH, WW, pad, stride, dilation=1):
+  """
+  Numpy equivalent of col2im_6d_cython, where cols has shape
+  (C, HH, WW, N, out_h, out_w) as in conv_backward_strides.
+  """
+  out_h = (H + 2 * pad - dilation * (HH - 1) - 1) / stride + 1
+  out_w = (W + 2 * pad - dilation * (WW - 1) - 1) / stride + 1
+  x_padded = buffers.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+  for hh in xrange(HH):
+    for ww in xrange(WW):
+      y0, x0 = dilation * hh, dilation * ww
+      x_padded[:, :, y0:y0 + stride * out_h:stride,
+               x0:x0 + stride * out_w:stride] += \
+          cols[:, hh, ww].transpose(1, 0, 2, 3)
+  if pad > 0:
+    return x_padded[:, :, pad:-pad, pad:-pad]
+  return x_padded
@@ -1,6 +1,10 @@
+import multiprocessing
+import os
+
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,15 +13,46 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The inner loops below run without the GIL and are split across images and
+# channels with OpenMP. Each (image, channel) pair reads and writes a disjoint
+# part of the data, so no synchronization is needed.
+def _default_num_threads():
+    # OMP_NUM_THREADS may be a list of counts for nested parallel regions,
+    # such as "4,2"; the first one applies to our loops.
+    value = os.environ.get('OMP_NUM_THREADS', '').split(',')[0].strip()
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    return multiprocessing.cpu_count()
+
+cdef int _num_threads = _default_num_threads()
+
+
+def set_num_threads(int num_threads):
+    """
+    Set the number of OpenMP threads used by the im2col / col2im kernels.
+    This has no effect if the extension was built without OpenMP.
+    """
+    global _num_threads
+    if num_threads < 1:
+        raise ValueError('num_threads must be positive, got %d' % num_threads)
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    """ Return the number of OpenMP threads used by the kernels. """
+    return _num_threads
+
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
-                  int field_width, int padding, int stride):
+                  int field_width, int padding, int stride, int dilation=1):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
+
+    # A dilated filter spans dilation * (size - 1) + 1 input pixels
+    cdef int HH = (H + 2 * padding - dilation * (field_height - 1) - 1) / stride + 1
+    cdef int WW = (W + 2 * padding - dilation * (field_width - 1) - 1) / stride + 1
 
     cdef int p = padding
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
@@ -27,95 +62,118 @@ def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
-                        field_height, field_width, padding, stride)
+    # Typed memoryviews let Cython pick the right specialization of the kernel
+    cdef DTYPE_t[:, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, :] x_padded_view = x_padded
+    im2col_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
+                        field_height, field_width, padding, stride,
+                        dilation, _num_threads)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int im2col_cython_inner(DTYPE_t[:, :] cols,
+                             DTYPE_t[:, :, :, :] x_padded,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
-        for yy in range(HH):
-            for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                             int field_height, int field_width, int padding,
+                             int stride, int dilation,
+                             int num_threads) nogil except? -1:
+    cdef int c, ii, jj, row, yy, xx, i, col, ci
+
+    for ci in prange(C * N, num_threads=num_threads, schedule='static'):
+        c = ci / N
+        i = ci % N
+        for ii in range(field_height):
+            for jj in range(field_width):
+                row = c * field_width * field_height + ii * field_width + jj
+                for yy in range(HH):
+                    for xx in range(WW):
+                        col = yy * WW * N + xx * N + i
+                        cols[row, col] = x_padded[i, c, stride * yy + dilation * ii,
+                                                  stride * xx + dilation * jj]
+    return 0
 
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
-                  int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
+                  int field_height, int field_width, int padding, int stride,
+                  int dilation=1):
+    cdef int HH = (H + 2 * padding - dilation * (field_height - 1) - 1) / stride + 1
+    cdef int WW = (W + 2 * padding - dilation * (field_width - 1) - 1) / stride + 1
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
                                         dtype=cols.dtype)
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
-                        field_height, field_width, padding, stride)
+    cdef DTYPE_t[:, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, :] x_padded_view = x_padded
+    col2im_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
+                        field_height, field_width, padding, stride,
+                        dilation, _num_threads)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
     return x_padded
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int col2im_cython_inner(DTYPE_t[:, :] cols,
+                             DTYPE_t[:, :, :, :] x_padded,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+                             int field_height, int field_width, int padding,
+                             int stride, int dilation,
+                             int num_threads) nogil except? -1:
+    cdef int c, ii, jj, row, yy, xx, i, col, ci
+
+    for ci in prange(C * N, num_threads=num_threads, schedule='static'):
+        c = ci / N
+        i = ci % N
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * field_width * field_height + ii * field_width + jj
                 for yy in range(HH):
                     for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                        col = yy * WW * N + xx * N + i
+                        x_padded[i, c, stride * yy + dilation * ii,
+                                 stride * xx + dilation * jj] += cols[row, col]
+    return 0
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+@cython.cdivision(True)
+cdef int col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, :] cols,
+                                DTYPE_t[:, :, :, :] x_padded,
+                                int N, int C, int H, int W, int HH, int WW,
+                                int out_h, int out_w, int pad, int stride,
+                                int dilation, int num_threads) nogil except? -1:
+
+    cdef int c, hh, ww, n, h, w, nc
+    for nc in prange(N * C, num_threads=num_threads, schedule='static'):
+        n = nc / C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    for w in range(out_w):
+                        x_padded[n, c, stride * h + dilation * hh,
+                                 stride * w + dilation * ww] += cols[c, hh, ww, n, h, w]
+    return 0
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
-        int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int out_h = (H + 2 * pad - HH) / stride + 1
-    cdef int out_w = (W + 2 * pad - WW) / stride + 1
+        int HH, int WW, int pad, int stride, int dilation=1):
+    cdef int out_h = (H + 2 * pad - dilation * (HH - 1) - 1) / stride + 1
+    cdef int out_w = (W + 2 * pad - dilation * (WW - 1) - 1) / stride + 1
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
                                                   dtype=cols.dtype)
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef DTYPE_t[:, :, :, :, :, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, :] x_padded_view = x_padded
+    col2im_6d_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
+                           out_h, out_w, pad, stride, dilation, _num_threads)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    return x_padded
@@ -22,11 +22,11 @@ def blur_image(X):
   Returns:
   - X_blur: Blurred version of X, of shape (N, 3, H, W)
   """
-  w_blur = np.zeros((3, 3, 3, 3))
+  # Each channel is blurred on its own, so this is a depthwise convolution
+  w_blur = np.zeros((3, 1, 3, 3))
   b_blur = np.zeros(3)
-  blur_param = {'stride': 1, 'pad': 1}
-  for i in xrange(3):
-    w_blur[i, i] = np.asarray([[1, 2, 1], [2, 188, 2], [1, 2, 1]], dtype=np.float32)
+  blur_param = {'stride': 1, 'pad': 1, 'groups': 3}
+  w_blur[:, 0] = np.asarray([[1, 2, 1], [2, 188, 2], [1, 2, 1]], dtype=np.float32)
   w_blur /= 200.0
   return conv_forward_fast(X, w_blur, b_blur, blur_param)[0]
 
@@ -1,21 +1,29 @@
+import copy
+
+import numpy as np
+
 from cs231n.layers import *
 from cs231n.fast_layers import *
 
 
-def affine_relu_forward(x, w, b):
+def affine_relu_forward(x, w, b, sparse_param=None, out_sparse_param=None):
   """
   Convenience layer that perorms an affine transform followed by a ReLU
 
   Inputs:
   - x: Input to the affine layer
   - w, b: Weights for the affine layer
+  - sparse_param: Optional sparse_param for the affine layer, passed to
+    affine_forward.
+  - out_sparse_param: Optional sparse_param for the ReLU, passed to
+    relu_forward.
 
   Returns a tuple of:
   - out: Output from the ReLU
   - cache: Object to give to the backward pass
   """
-  a, fc_cache = affine_forward(x, w, b)
-  out, relu_cache = relu_forward(a)
+  a, fc_cache = affine_forward(x, w, b, sparse_param)
+  out, relu_cache = relu_forward(a, out_sparse_param)
   cache = (fc_cache, relu_cache)
   return out, cache
 
@@ -30,7 +38,8 @@ def affine_relu_backward(dout, cache):
   return dx, dw, db
 
 
-def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param, sparse_param=None,
+                           out_sparse_param=None):
   """
   Convenience layer that performs an affine transform, batch normalization,
   and ReLU.
@@ -42,14 +51,16 @@ def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
   - gamma, beta: Arrays of shape (D2,) and (D2,) giving scale and shift
     parameters for batch normalization.
   - bn_param: Dictionary of parameters for batch normalization.
+  - sparse_param, out_sparse_param: Optional sparse_params for the affine
+    layer and the ReLU; see affine_relu_forward.
 
   Returns:
   - out: Output from ReLU, of shape (N, D2)
   - cache: Object to give to the backward pass.
   """
-  a, fc_cache = affine_forward(x, w, b)
+  a, fc_cache = affine_forward(x, w, b, sparse_param)
   a_bn, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
-  out, relu_cache = relu_forward(a_bn)
+  out, relu_cache = relu_forward(a_bn, out_sparse_param)
   cache = (fc_cache, bn_cache, relu_cache)
   return out, cache
 
@@ -109,6 +120,47 @@ def conv_bn_relu_backward(dout, cache):
   return dx, dw, db, dgamma, dbeta
 
 
+def conv_bn_relu_forward_nhwc(x, w, b, gamma, beta, conv_param, bn_param):
+  """
+  Channels-last version of conv_bn_relu_forward; x has shape (N, H, W, C)
+  and the output has shape (N, H', W', F).
+  """
+  a, conv_cache = conv_forward_nhwc(x, w, b, conv_param)
+  an, bn_cache = spatial_batchnorm_forward_nhwc(a, gamma, beta, bn_param)
+  out, relu_cache = relu_forward(an)
+  cache = (conv_cache, bn_cache, relu_cache)
+  return out, cache
+
+
+def conv_bn_relu_backward_nhwc(dout, cache):
+  conv_cache, bn_cache, relu_cache = cache
+  dan = relu_backward(dout, relu_cache)
+  da, dgamma, dbeta = spatial_batchnorm_backward_nhwc(dan, bn_cache)
+  dx, dw, db = conv_backward_nhwc(da, conv_cache)
+  return dx, dw, db, dgamma, dbeta
+
+
+def conv_relu_forward_nhwc(x, w, b, conv_param):
+  """
+  Channels-last version of conv_relu_forward; x has shape (N, H, W, C)
+  and the output has shape (N, H', W', F).
+  """
+  a, conv_cache = conv_forward_nhwc(x, w, b, conv_param)
+  out, relu_cache = relu_forward(a)
+  cache = (conv_cache, relu_cache)
+  return out, cache
+
+
+def conv_relu_backward_nhwc(dout, cache):
+  """
+  Backward pass for the channels-last conv-relu convenience layer
+  """
+  conv_cache, relu_cache = cache
+  da = relu_backward(dout, relu_cache)
+  dx, dw, db = conv_backward_nhwc(da, conv_cache)
+  return dx, dw, db
+
+
 def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
   """
   Convenience layer that performs a convolution, a ReLU, and a pool.
@@ -139,3 +191,162 @@ def conv_relu_pool_backward(dout, cache):
   dx, dw, db = conv_backward_fast(da, conv_cache)
   return dx, dw, db
 
+
+def conv_relu_pool_forward_nhwc(x, w, b, conv_param, pool_param):
+  """
+  Channels-last version of conv_relu_pool_forward; x has shape (N, H, W, C)
+  and the output has shape (N, H', W', F).
+  """
+  a, conv_cache = conv_forward_nhwc(x, w, b, conv_param)
+  s, relu_cache = relu_forward(a)
+  out, pool_cache = max_pool_forward_nhwc(s, pool_param)
+  cache = (conv_cache, relu_cache, pool_cache)
+  return out, cache
+
+
+def conv_relu_pool_backward_nhwc(dout, cache):
+  """
+  Backward pass for the channels-last conv-relu-pool convenience layer
+  """
+  conv_cache, relu_cache, pool_cache = cache
+  ds = max_pool_backward_nhwc(dout, pool_cache)
+  da = relu_backward(ds, relu_cache)
+  dx, dw, db = conv_backward_nhwc(da, conv_cache)
+  return dx, dw, db
+
+
+def conv_relu_avg_pool_forward(x, w, b, conv_param, pool_param):
+  """
+  Convenience layer that performs a convolution, a ReLU, and an average pool.
+
+  Inputs:
+  - x: Input to the convolutional layer
+  - w, b, conv_param: Weights and parameters for the convolutional layer
+  - pool_param: Parameters for the pooling layer
+
+  Returns a tuple of:
+  - out: Output from the pooling layer
+  - cache: Object to give to the backward pass
+  """
+  a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+  s, relu_cache = relu_forward(a)
+  out, pool_cache = avg_pool_forward_fast(s, pool_param)
+  cache = (conv_cache, relu_cache, pool_cache)
+  return out, cache
+
+
+def conv_relu_avg_pool_backward(dout, cache):
+  """
+  Backward pass for the conv-relu-avg_pool convenience layer
+  """
+  conv_cache, relu_cache, pool_cache = cache
+  ds = avg_pool_backward_fast(dout, pool_cache)
+  da = relu_backward(ds, relu_cache)
+  dx, dw, db = conv_backward_fast(da, conv_cache)
+  return dx, dw, db
+
+
+def global_avg_pool_affine_forward(x, w, b):
+  """
+  Convenience layer that averages each channel over all spatial positions and
+  then performs an affine transform. As a classifier head this replaces
+  flattening the feature maps into a large affine layer: w has shape (C, M)
+  rather than (C * H * W, M).
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+  - w, b: Weights for the affine layer, of shapes (C, M) and (M,)
+
+  Returns a tuple of:
+  - out: Output from the affine layer, of shape (N, M)
+  - cache: Object to give to the backward pass
+  """
+  a, pool_cache = global_avg_pool_forward(x)
+  out, fc_cache = affine_forward(a, w, b)
+  cache = (pool_cache, fc_cache)
+  return out, cache
+
+
+def global_avg_pool_affine_backward(dout, cache):
+  """
+  Backward pass for the global_avg_pool-affine convenience layer
+  """
+  pool_cache, fc_cache = cache
+  da, dw, db = affine_backward(dout, fc_cache)
+  dx = global_avg_pool_backward(da, pool_cache)
+  return dx, dw, db
+
+
+def checkpoint_forward(layer_forward, x, *args):
+  """
+  Run layer_forward(x, *args) without keeping its cache; only the inputs are
+  kept, and checkpoint_backward runs the layer forward again to rebuild the
+  cache just before it is needed. Wrapping a block of layers this way trades
+  a second forward pass for not holding its intermediate activations in memory
+  between the forward and backward passes.
+
+  layer_forward must produce the same output when run again on the same
+  inputs, so this cannot wrap layers that draw random numbers, such as
+  dropout without a fixed seed. Dictionary arguments are copied for the
+  second run, so running averages in a bn_param are only updated once.
+
+  Inputs:
+  - layer_forward: Forward function of a layer or convenience layer
+  - x, args: Arguments for layer_forward
+
+  Returns a tuple of:
+  - out: Output from layer_forward
+  - cache: Object to give to checkpoint_backward
+  """
+  out, _ = layer_forward(x, *args)
+  cache = (layer_forward, x, args)
+  return out, cache
+
+
+def checkpoint_backward(layer_backward, dout, cache):
+  """
+  Backward pass for a layer run with checkpoint_forward, where layer_backward
+  is the backward function that matches its layer_forward.
+  """
+  layer_forward, x, args = cache
+  args = [copy.deepcopy(arg) if isinstance(arg, dict) else arg for arg in args]
+  _, layer_cache = layer_forward(x, *args)
+  return layer_backward(dout, layer_cache)
+
+
+def fold_batchnorm(w, b, gamma, beta, bn_param):
+  """
+  Fold a batch normalization layer in test mode into the weights and biases
+  of the affine or convolutional layer before it.
+
+  At test time batch normalization computes gamma * (a - mean) / std + beta
+  for each feature (or channel) of the output a of the previous layer, using
+  the running averages in bn_param, which is itself an affine function of a.
+  Scaling the weights and shifting the biases of the previous layer gives a
+  single layer that computes the same output without a separate pass over
+  its activations.
+
+  Inputs:
+  - w, b: Weights and biases of the previous layer; either an affine layer
+    with w of shape (D, M) and b of shape (M,), or a convolutional layer with
+    w of shape (F, C, HH, WW) and b of shape (F,).
+  - gamma, beta: Scale and shift parameters of the batch normalization layer,
+    of the same shape as b.
+  - bn_param: bn_param of the batch normalization layer, holding the running
+    averages and optionally eps.
+
+  Returns a tuple of:
+  - w_folded, b_folded: Weights and biases of the folded layer, of the same
+    shapes and dtypes as w and b.
+  """
+  eps = bn_param.get('eps', 1e-5)
+  running_mean = bn_param.get('running_mean', np.zeros(b.shape))
+  running_var = bn_param.get('running_var', np.zeros(b.shape))
+
+  scale = gamma / np.sqrt(running_var + eps)
+  if w.ndim == 2:
+    w_folded = w * scale
+  else:
+    w_folded = w * scale.reshape((-1,) + (1,) * (w.ndim - 1))
+  b_folded = (b - running_mean) * scale + beta
+  return w_folded.astype(w.dtype), b_folded.astype(b.dtype)
@@ -1,7 +1,18 @@
 import numpy as np
 
+from cs231n import buffers
+try:
+  import scipy.sparse
+except ImportError:
+  scipy = None
 
-def affine_forward(x, w, b):
+
+# Default density below which relu_forward and affine_forward take their
+# sparse paths; see sparsity_stats to measure the density of a network.
+_SPARSE_DENSITY_THRESHOLD = 0.15
+
+
+def affine_forward(x, w, b, sparse_param=None):
   """
   Computes the forward pass for an affine (fully-connected) layer.
 
@@ -13,13 +24,30 @@ def affine_forward(x, w, b):
   x - Input data, of shape (N, d_1, ..., d_k)
   w - Weights, of shape (D, M)
   b - Biases, of shape (M,)
+  sparse_param - Optional dictionary for sparse inputs, such as the output of
+    a ReLU. If the density (fraction of nonzero entries) of x is below
+    sparse_param['threshold'] (default 0.15), x is converted to a CSR sparse
+    matrix, and the products with w and the weight gradient in
+    affine_backward only touch its nonzero entries, skipping the zeros of
+    every example. This needs scipy, and it only pays off for low densities
+    and wide layers; the density is recorded in sparse_param either way, see
+    sparsity_stats.
   
   Returns a tuple of:
   - out: output, of shape (N, M)
-  - cache: (x, w, b)
+  - cache: (x, w, b), or (x_csr, w, b, x.shape) on the sparse path
   """
-  out = x.reshape(x.shape[0], -1).dot(w) + b
-  cache = (x, w, b)
+  x_rows = x.reshape(x.shape[0], -1)
+  if sparse_param is not None and _use_sparse(x_rows, sparse_param, 'affine',
+                                              scipy is not None):
+    x_csr = scipy.sparse.csr_matrix(x_rows)
+    out = x_csr.dot(w)
+    cache = (x_csr, w, b, x.shape)
+  else:
+    out = buffers.empty((x.shape[0], w.shape[1]), dtype=np.result_type(x, w))
+    np.dot(x_rows, w, out=out)
+    cache = (x, w, b)
+  out += b
   return out, cache
 
 
@@ -38,26 +66,43 @@ def affine_backward(dout, cache):
   - dw: Gradient with respect to w, of shape (D, M)
   - db: Gradient with respect to b, of shape (M,)
   """
-  x, w, b = cache
-  dx = dout.dot(w.T).reshape(x.shape)
-  dw = x.reshape(x.shape[0], -1).T.dot(dout)
+  if len(cache) == 4:
+    # Sparse path: the product with the CSR matrix skips the zeros of x
+    x_csr, w, b, x_shape = cache
+    dx = buffers.empty(x_shape, dtype=np.result_type(dout, w))
+    np.dot(dout, w.T, out=dx.reshape(dout.shape[0], -1))
+    dw = x_csr.T.dot(dout)
+  else:
+    x, w, b = cache
+    dx = buffers.empty(x.shape, dtype=np.result_type(dout, w))
+    np.dot(dout, w.T, out=dx.reshape(dout.shape[0], -1))
+    dw = buffers.empty(w.shape, dtype=np.result_type(x, dout))
+    np.dot(x.reshape(x.shape[0], -1).T, dout, out=dw)
   db = np.sum(dout, axis=0)
   return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, sparse_param=None):
   """
   Computes the forward pass for a layer of rectified linear units (ReLUs).
 
   Input:
   - x: Inputs, of any shape
+  - sparse_param: Optional dictionary. If given, the density of the output is
+    recorded in it (see sparsity_stats), and if the density is below
+    sparse_param['threshold'] (default 0.15), the cache holds the indices of
+    the nonzero outputs instead of x.
 
   Returns a tuple of:
   - out: Output, of the same shape as x
-  - cache: x
+  - cache: x, or (x.shape, indices of the nonzero outputs) if sparse
   """
-  out = np.maximum(0, x)
-  cache = x
+  out = np.maximum(0, x, out=buffers.empty(x.shape, dtype=x.dtype))
+  if sparse_param is not None and _use_sparse(out, sparse_param, 'relu'):
+    index_dtype = np.int32 if out.size < 2 ** 31 else np.int64
+    cache = (x.shape, np.flatnonzero(out).astype(index_dtype))
+  else:
+    cache = x
   return out, cache
 
 
@@ -67,16 +112,75 @@ def relu_backward(dout, cache):
 
   Input:
   - dout: Upstream derivatives, of any shape
-  - cache: Input x, of same shape as dout
+  - cache: Input x, of same shape as dout, or the compact cache of a sparse
+    relu_forward
 
   Returns:
   - dx: Gradient with respect to x
   """
-  x = cache
-  dx = np.where(x > 0, dout, 0)
+  dx = buffers.zeros(dout.shape, dtype=dout.dtype)
+  if isinstance(cache, tuple):
+    _, active = cache
+    dx.reshape(-1)[active] = dout.reshape(-1)[active]
+  else:
+    x = cache
+    np.copyto(dx, dout, where=x > 0)
   return dx
 
 
+def _sparse_stats(sparse_param):
+  return sparse_param.setdefault('stats', {
+    'relu_calls': 0, 'sparse_relu_calls': 0,
+    'affine_calls': 0, 'sparse_affine_calls': 0,
+    'density': None, 'density_sum': 0.0, 'density_count': 0,
+  })
+
+
+def _use_sparse(a, sparse_param, layer, available=True):
+  """
+  Measure the density (the fraction of nonzero entries) of the activations a,
+  record it in the statistics of sparse_param for the given layer ('relu' or
+  'affine'), and return whether the layer should take its sparse path, which
+  is when the density is below sparse_param['threshold'].
+  """
+  density = float(np.count_nonzero(a)) / max(a.size, 1)
+  use_sparse = available and density < sparse_param.get(
+      'threshold', _SPARSE_DENSITY_THRESHOLD)
+
+  stats = _sparse_stats(sparse_param)
+  stats['density'] = density
+  stats['density_sum'] += density
+  stats['density_count'] += 1
+  stats[layer + '_calls'] += 1
+  if use_sparse:
+    stats['sparse_' + layer + '_calls'] += 1
+  return use_sparse
+
+
+def sparsity_stats(sparse_param):
+  """
+  Return a dictionary of sparsity statistics for a sparse_param that has been
+  passed to relu_forward and / or affine_forward:
+  - relu_calls: Number of ReLU forward passes that measured their output.
+  - sparse_relu_calls: Number of those that kept a compact cache.
+  - affine_calls: Number of affine forward passes that measured their input.
+  - sparse_affine_calls: Number of those that took the sparse path.
+  - density: Fraction of nonzero entries in the last activations measured.
+  - mean_density: Average density over all measurements.
+  """
+  stats = _sparse_stats(sparse_param)
+  count = stats['density_count']
+  return {
+    'relu_calls': stats['relu_calls'],
+    'sparse_relu_calls': stats['sparse_relu_calls'],
+    'affine_calls': stats['affine_calls'],
+    'sparse_affine_calls': stats['sparse_affine_calls'],
+    'density': stats['density'],
+    'mean_density': stats['density_sum'] / count if count else None,
+  }
+
+
+
 def batchnorm_forward(x, gamma, beta, bn_param):
   """
   Forward pass for batch normalization.
@@ -120,8 +224,10 @@ def batchnorm_forward(x, gamma, beta, bn_param):
   momentum = bn_param.get('momentum', 0.9)
 
   N, D = x.shape
-  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
-  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+  # Running averages are always real, even when x is complex (as it is when
+  # gradient checking with the complex step method)
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.real.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.real.dtype))
 
   out, cache = None, None
   if mode == 'train':
@@ -137,11 +243,11 @@ def batchnorm_forward(x, gamma, beta, bn_param):
 
     # Update running average of mean
     running_mean *= momentum
-    running_mean += (1 - momentum) * mu
+    running_mean += (1 - momentum) * np.real(mu)
 
     # Update running average of variance
     running_var *= momentum
-    running_var += (1 - momentum) * var
+    running_var += (1 - momentum) * np.real(var)
   elif mode == 'test':
     # Using running mean and variance to normalize
     std = np.sqrt(running_var + eps)
@@ -196,7 +302,7 @@ def batchnorm_backward(dout, cache):
     dxn = gamma * dout
     dx = dxn / std
   else:
-    raise ValueError(mode)
+    raise ValueError('Invalid backward batchnorm mode "%s"' % mode)
 
   return dx, dgamma, dbeta
 
@@ -223,10 +329,40 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   - out: Output data, of shape (N, C, H, W)
   - cache: Values needed for the backward pass
   """
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
+  # Per-channel statistics are computed by reducing over axes (0, 2, 3) of x
+  # directly, and per-channel vectors are broadcast against shape (C, 1, 1),
+  # so x is never transposed into an (N * H * W, C) copy.
   N, C, H, W = x.shape
-  x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
-  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
-  out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.real.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.real.dtype))
+
+  if mode == 'train':
+    mean = x.mean(axis=(0, 2, 3))
+    x_hat = x - mean.reshape(C, 1, 1)
+    var = np.einsum('nchw,nchw->c', x_hat, x_hat) / (N * H * W)
+
+    running_mean = momentum * running_mean + (1 - momentum) * np.real(mean)
+    running_var = momentum * running_var + (1 - momentum) * np.real(var)
+  elif mode == 'test':
+    var = running_var
+    x_hat = x - running_mean.astype(x.dtype).reshape(C, 1, 1)
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  inv_std = (1.0 / np.sqrt(var + eps)).astype(x.dtype)
+  x_hat *= inv_std.reshape(C, 1, 1)
+  out = x_hat * gamma.astype(x.dtype).reshape(C, 1, 1)
+  out += beta.astype(x.dtype).reshape(C, 1, 1)
+
+  # Store the updated running means back into bn_param
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
+
+  cache = (mode, x_hat, inv_std, gamma)
   return out, cache
 
 
@@ -243,13 +379,138 @@ def spatial_batchnorm_backward(dout, cache):
   - dgamma: Gradient with respect to scale parameter, of shape (C,)
   - dbeta: Gradient with respect to shift parameter, of shape (C,)
   """
+  mode, x_hat, inv_std, gamma = cache
   N, C, H, W = dout.shape
-  dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
-  dx_flat, dgamma, dbeta = batchnorm_backward(dout_flat, cache)
-  dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  scale = (gamma * inv_std).astype(dout.dtype).reshape(C, 1, 1)
+
+  dbeta = dout.sum(axis=(0, 2, 3))
+  dgamma = np.einsum('nchw,nchw->c', dout, x_hat)
+  if mode == 'train':
+    # dx = gamma * inv_std * (dout - mean(dout) - x_hat * mean(dout * x_hat)),
+    # with the means taken over axes (0, 2, 3)
+    M = float(N * H * W)
+    dx = x_hat * (dgamma / M).astype(dout.dtype).reshape(C, 1, 1)
+    dx -= dout
+    dx += (dbeta / M).astype(dout.dtype).reshape(C, 1, 1)
+    dx *= -scale
+  elif mode == 'test':
+    dx = dout * scale
+  else:
+    raise ValueError('Invalid backward batchnorm mode "%s"' % mode)
   return dx, dgamma, dbeta
 
 
+def spatial_batchnorm_forward_nhwc(x, gamma, beta, bn_param):
+  """
+  Computes the forward pass for spatial batch normalization on channels-last
+  data. Each channel is a column of x.reshape(-1, C), which is a view of x, so
+  this is plain batch normalization without any copies.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - gamma, beta, bn_param: As for spatial_batchnorm_forward
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H, W, C)
+  - cache: Values needed for the backward pass
+  """
+  C = x.shape[-1]
+  out, cache = batchnorm_forward(x.reshape(-1, C), gamma, beta, bn_param)
+  return out.reshape(x.shape), cache
+
+
+def spatial_batchnorm_backward_nhwc(dout, cache):
+  """
+  Computes the backward pass for spatial batch normalization on channels-last
+  data.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H, W, C)
+  - cache: Values from the forward pass
+
+  Returns a tuple of:
+  - dx: Gradient with respect to inputs, of shape (N, H, W, C)
+  - dgamma: Gradient with respect to scale parameter, of shape (C,)
+  - dbeta: Gradient with respect to shift parameter, of shape (C,)
+  """
+  C = dout.shape[-1]
+  dx, dgamma, dbeta = batchnorm_backward(dout.reshape(-1, C), cache)
+  return dx.reshape(dout.shape), dgamma, dbeta
+
+
+def global_avg_pool_forward(x):
+  """
+  Forward pass for a global average pooling layer, which averages each
+  channel over all spatial positions.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C)
+  - cache: Shape of x, for the backward pass
+  """
+  out = x.mean(axis=(2, 3))
+  cache = x.shape
+  return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+  """
+  Backward pass for a global average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C)
+  - cache: Shape of x, as from global_avg_pool_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  N, C, H, W = cache
+  dx = np.empty(cache, dtype=dout.dtype)
+  dx[...] = (dout / float(H * W))[:, :, None, None]
+  return dx
+
+
+def global_max_pool_forward(x):
+  """
+  Forward pass for a global max pooling layer, which takes the maximum of each
+  channel over all spatial positions.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C)
+  - cache: (x_shape, argmax), where argmax gives the flat spatial position of
+    each maximum in the smallest unsigned integer type that fits.
+  """
+  N, C, H, W = x.shape
+  x_flat = x.reshape(N, C, H * W)
+  argmax = np.argmax(x_flat, axis=2)
+  out = x_flat.max(axis=2)
+  cache = (x.shape, argmax.astype(np.min_scalar_type(H * W - 1)))
+  return out, cache
+
+
+def global_max_pool_backward(dout, cache):
+  """
+  Backward pass for a global max pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C)
+  - cache: (x_shape, argmax) as from global_max_pool_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  x_shape, argmax = cache
+  N, C, H, W = x_shape
+  dx = np.zeros((N * C, H * W), dtype=dout.dtype)
+  dx[np.arange(N * C), argmax.ravel()] = dout.ravel()
+  return dx.reshape(x_shape)
+
+
 def svm_loss(x, y):
   """
   Computes the loss and gradient using for multiclass SVM classification.
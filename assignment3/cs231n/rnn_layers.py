@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n import buffers
+
 
 """
 This file defines layer types that are commonly used for recurrent neural
@@ -107,7 +109,7 @@ def rnn_forward(x, h0, Wx, Wh, b):
   N, T, D = x.shape
   _, H = Wh.shape
 
-  h = np.zeros((N, T, H))
+  h = buffers.zeros((N, T, H))
   cache = []
 
   # h[:, -1, :] = h0
@@ -149,7 +151,7 @@ def rnn_backward(dh, cache):
   _, D = cache[0][0].shape # unpacking x
 
 
-  dx = np.zeros((N, T, D))
+  dx = buffers.zeros((N, T, D))
   dh0 = np.zeros((N, H))
   db = np.zeros((H))
   dWh = np.zeros((H, H))
@@ -392,8 +394,8 @@ def lstm_forward(x, h0, Wx, Wh, b):
   N, T, D = x.shape
   _, H = h0.shape
 
-  h = np.zeros((N, T+1, H)) # T+1 and not T for compatibility with the for loop
-  c = np.zeros((N, T+1, H))
+  h = buffers.zeros((N, T+1, H)) # T+1 and not T for compatibility with the for loop
+  c = buffers.zeros((N, T+1, H))
   cache = []
 
   h[:, 0, :] = h0
@@ -438,13 +440,13 @@ def lstm_backward(dh, cache):
   N, T, H = dh.shape
 
   # init
-  dx = np.zeros((N, T, D))
+  dx = buffers.zeros((N, T, D))
   dh0 = np.zeros((N, H))
   dWx = np.zeros((D, 4 * H))
   dWh = np.zeros((H, 4 * H))
   db = np.zeros((4 * H))
 
-  dc = np.zeros((N, T+1, H))
+  dc = buffers.zeros((N, T+1, H))
   dprev_h = np.zeros_like(dh0)
 
   for t in reversed(xrange(T)):
@@ -455,6 +457,7 @@ def lstm_backward(dh, cache):
     dWx += dWx_t
     dWh += dWh_t
     db += db_t
+  buffers.release(dc)
 
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -481,7 +484,9 @@ def temporal_affine_forward(x, w, b):
   """
   N, T, D = x.shape
   M = b.shape[0]
-  out = x.reshape(N * T, D).dot(w).reshape(N, T, M) + b
+  out = buffers.empty((N, T, M), dtype=np.result_type(x, w))
+  np.dot(x.reshape(N * T, D), w, out=out.reshape(N * T, M))
+  out += b
   cache = x, w, b, out
   return out, cache
 
@@ -503,7 +508,8 @@ def temporal_affine_backward(dout, cache):
   N, T, D = x.shape
   M = b.shape[0]
 
-  dx = dout.reshape(N * T, M).dot(w.T).reshape(N, T, D)
+  dx = buffers.empty((N, T, D), dtype=np.result_type(dout, w))
+  np.dot(dout.reshape(N * T, M), w.T, out=dx.reshape(N * T, D))
   dw = dout.reshape(N * T, M).T.dot(x.reshape(N * T, D)).T
   db = dout.sum(axis=(0, 1))
 
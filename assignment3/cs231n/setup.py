@@ -1,11 +1,23 @@
+import os
+
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The kernels are parallelized with OpenMP. Compilers without OpenMP support
+# (such as the default clang on OSX) can build a single-threaded version by
+# setting the environment variable CS231N_NO_OPENMP=1.
+if os.environ.get('CS231N_NO_OPENMP'):
+  openmp_args = []
+else:
+  openmp_args = ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = ['-O3'] + openmp_args,
+            extra_link_args = openmp_args,
   ),
 ]
 